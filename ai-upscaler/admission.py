@@ -0,0 +1,170 @@
+import hmac
+import math
+import time
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+import pika
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Atomic token bucket: refills continuously at `rate` tokens/s up to `capacity`.
+# Returns {allowed, milliseconds until `cost` tokens are available}.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+
+local allowed = 0
+local wait_ms = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait_ms = math.ceil((cost - tokens) / rate * 1000)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return {allowed, wait_ms}
+"""
+
+@dataclass
+class AdmissionDecision:
+    allowed: bool
+    retry_after: int = 0
+    reason: str = ""
+    tier: str = ""
+
+def verified_user_id(user_id, signature):
+    """Accept X-User-Id only when the auth gateway signed it with ADMISSION_IDENTITY_SECRET.
+
+    signature = hex(HMAC-SHA256(secret, user_id)). Unsigned or forged ids
+    return None so they can't rotate buckets or borrow another user's tier.
+    """
+    if not (Config.ADMISSION_IDENTITY_SECRET and user_id and signature):
+        return None
+    expected = hmac.new(Config.ADMISSION_IDENTITY_SECRET.encode(), user_id.encode(), hashlib.sha256).hexdigest()
+    return user_id if hmac.compare_digest(expected, signature) else None
+
+class AdmissionController:
+    """Per-user (or per-IP) token buckets plus queue-depth-aware load shedding for upscale_jobs"""
+
+    def __init__(self, redis_client, queue_name='upscale_jobs'):
+        self.redis_client = redis_client
+        self.queue_name = queue_name
+        self.token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._backlog = None
+        self._backlog_checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_tier(self, user_id: str) -> str:
+        """Resolve a user's tier; assigned out of band in user_tier:{user_id}"""
+        tier = self.redis_client.get(f"user_tier:{user_id}")
+        tier = tier.decode() if tier else Config.ADMISSION_DEFAULT_TIER
+        return tier if tier in Config.ADMISSION_TIERS else Config.ADMISSION_DEFAULT_TIER
+
+    def _refresh_backlog(self):
+        """Read queue depth from RabbitMQ and the drain rate from worker drain counters"""
+        connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
+        try:
+            channel = connection.channel()
+            method = channel.queue_declare(queue=self.queue_name, passive=True)
+            depth = method.method.message_count
+            consumers = method.method.consumer_count
+        finally:
+            connection.close()
+
+        now = time.time()
+        current_minute = int(now // 60)
+        if depth > 0:
+            # Remember minutes in which work was waiting; only those drains measure capacity
+            key = f"stats:backlogged:{current_minute}"
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.set(key, 1)
+            pipeline.expire(key, 3600)
+            pipeline.execute()
+
+        # Workers bump stats:drained:{minute} for every message they finish handling
+        minutes = list(range(current_minute - Config.ADMISSION_DRAIN_WINDOW_MINUTES, current_minute + 1))
+        drained = self.redis_client.mget([f"stats:drained:{minute}" for minute in minutes])
+        backlogged = self.redis_client.mget([f"stats:backlogged:{minute}" for minute in minutes])
+
+        busy_drained = 0
+        busy_seconds = 0.0
+        for minute, count, flagged in zip(minutes, drained, backlogged):
+            if flagged:
+                busy_drained += int(count) if count else 0
+                busy_seconds += min(60.0, now - minute * 60)
+
+        if busy_drained > 0:
+            # Workers had a queue to pull from, so drains are the real throughput
+            drain_rate = busy_drained / busy_seconds
+        else:
+            # An idle queue only measures demand; assume every consumer runs at the nominal job time
+            drain_rate = consumers / Config.ADMISSION_EST_JOB_SECONDS
+
+        return {"depth": depth, "consumers": consumers, "drain_rate": drain_rate}
+
+    def get_backlog(self):
+        """Cached queue depth and drain rate, refreshed at most every ADMISSION_QUEUE_CACHE_SECONDS"""
+        with self._lock:
+            if self._backlog is None or time.time() - self._backlog_checked_at > Config.ADMISSION_QUEUE_CACHE_SECONDS:
+                self._backlog = self._refresh_backlog()
+                self._backlog_checked_at = time.time()
+            return self._backlog
+
+    def check(self, user_id, cost: int = 1, client_ip=None) -> AdmissionDecision:
+        """Decide whether `cost` new jobs may be enqueued.
+
+        Verified users get their tier's token bucket, batch cap and wait budget.
+        Anonymous requests (user_id None) share the ADMISSION_ANONYMOUS_TIER limits,
+        with one token bucket per client IP.
+        """
+        try:
+            tier = Config.ADMISSION_ANONYMOUS_TIER if user_id is None else self.get_tier(user_id)
+            limits = Config.ADMISSION_TIERS[tier]
+            if cost > limits["capacity"]:
+                return AdmissionDecision(False, 0, "batch_too_large", tier)
+
+            # Shed load first, so rejected requests don't burn the user's tokens
+            backlog = self.get_backlog()
+            if backlog["drain_rate"] <= 0:
+                if backlog["depth"] > 0:
+                    return AdmissionDecision(False, Config.ADMISSION_NO_CONSUMER_RETRY_SECONDS, "no_workers", tier)
+            else:
+                # Wait until this request's last job starts, so none of its jobs outlive their TTL
+                estimated_wait = (backlog["depth"] + cost) / backlog["drain_rate"]
+                if cost / backlog["drain_rate"] > limits["max_queue_wait_seconds"]:
+                    # Too big even for an empty queue: retrying later would never help
+                    return AdmissionDecision(False, 0, "batch_exceeds_capacity", tier)
+                if estimated_wait > limits["max_queue_wait_seconds"]:
+                    retry_after = math.ceil(estimated_wait - limits["max_queue_wait_seconds"])
+                    return AdmissionDecision(False, retry_after, "queue_saturated", tier)
+
+            if user_id is None and not client_ip:
+                return AdmissionDecision(True, tier=tier)
+            bucket = user_id if user_id is not None else f"ip:{client_ip}"
+
+            allowed, wait_ms = self.token_bucket(
+                keys=[f"ratelimit:{bucket}"],
+                args=[limits["capacity"], limits["refill_per_second"], time.time(), cost]
+            )
+            if not allowed:
+                return AdmissionDecision(False, max(1, math.ceil(wait_ms / 1000)), "rate_limited", tier)
+
+            return AdmissionDecision(True, tier=tier)
+
+        except Exception as e:
+            # Fail open: an admission-control outage must not take uploads down with it
+            logger.warning(f"Admission check failed, admitting request: {e}")
+            return AdmissionDecision(True, reason="admission_unavailable")
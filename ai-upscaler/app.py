@@ -1,11 +1,23 @@
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Request
-from fastapi.responses import JSONResponse, Response
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, BackgroundTasks
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 import httpx
 from config import Config
+from batch import is_zip_upload, zip_image_entries, aggregate_group_status, unique_archive_name, job_type_for, rewound
+from preview import generate_preview
+from admission import AdmissionController, verified_user_id
+from profiling import create_router as create_profiling_router
+from typing import List
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import tempfile
+import zipfile
 import uuid
 import json
 from analytics import analytics_client
@@ -42,18 +54,66 @@ app.add_middleware(
 s3_client_config = {
     'aws_access_key_id': Config.AWS_ACCESS_KEY_ID,
     'aws_secret_access_key': Config.AWS_SECRET_ACCESS_KEY,
-    'region_name': Config.AWS_DEFAULT_REGION
+    'region_name': Config.AWS_DEFAULT_REGION,
+    'config': BotoConfig(max_pool_connections=Config.S3_MAX_POOL_CONNECTIONS)
 }
 
 # Only use endpoint_url for local development
-if Config.AWS_ENDPOINT_URL and 'localhost' in Config.AWS_ENDPOINT_URL:
+if Config.AWS_ENDPOINT_URL:
     s3_client_config['endpoint_url'] = Config.AWS_ENDPOINT_URL
 
 s3_client = boto3.client('s3', **s3_client_config)
 
+# Presigned URLs are opened by the browser, so sign them for the public endpoint
+if Config.AWS_PUBLIC_ENDPOINT_URL:
+    presign_client = boto3.client('s3', **{**s3_client_config, 'endpoint_url': Config.AWS_PUBLIC_ENDPOINT_URL})
+else:
+    presign_client = s3_client
+
 # Initialize Redis client
 redis_client = redis.from_url(Config.REDIS_URL)
 
+# Thread pool for concurrent S3 transfers in batch submissions and downloads
+s3_executor = ThreadPoolExecutor(max_workers=Config.BATCH_UPLOAD_CONCURRENCY)
+# Batch inputs are already uploaded in parallel, one file per s3_executor thread
+batch_transfer_config = TransferConfig(use_threads=False)
+
+admission = AdmissionController(redis_client)
+
+# Token-protected /debug/profile endpoints (CPU sampling, tracemalloc)
+app.include_router(create_profiling_router("api"))
+
+def admit_request(request: Request, cost: int = 1):
+    """Reject with 429 + Retry-After when the user is over quota or the queue is saturated"""
+    if not Config.ADMISSION_ENABLED:
+        return
+    
+    user_id = verified_user_id(request.headers.get("X-User-Id"), request.headers.get("X-User-Signature"))
+    # Unsigned callers are rate limited per client address (uvicorn only honours
+    # X-Forwarded-For from its trusted --forwarded-allow-ips)
+    client_ip = request.client.host if request.client else None
+    decision = admission.check(user_id, cost, client_ip)
+    if decision.allowed:
+        return
+    
+    metrics.record_admission_rejection(decision.tier, decision.reason)
+    logger.info(f"Admission rejected for {user_id or client_ip or 'anonymous'} ({decision.tier}): {decision.reason}, retry after {decision.retry_after}s")
+    if decision.reason == "batch_too_large":
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {cost} files exceeds the {Config.ADMISSION_TIERS[decision.tier]['capacity']} file limit for tier '{decision.tier}'"
+        )
+    if decision.reason == "batch_exceeds_capacity":
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {cost} files cannot finish queueing within the {Config.ADMISSION_TIERS[decision.tier]['max_queue_wait_seconds']}s budget for tier '{decision.tier}' at current worker capacity"
+        )
+    raise HTTPException(
+        status_code=429,
+        detail=f"Too many requests: {decision.reason}",
+        headers={"Retry-After": str(decision.retry_after)}
+    )
+
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
     """Middleware to record API metrics"""
@@ -110,25 +170,71 @@ def publish_to_queue(message, queue_name):
         logger.error(f"Failed to publish message to RabbitMQ: {e}", exc_info=True)
         raise
 
+def publish_batch_to_queue(messages, queue_name):
+    """Publish a batch of messages to RabbitMQ in a single transaction"""
+    logger.info(f"Attempting to publish {len(messages)} messages to queue '{queue_name}'")
+    connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
+    try:
+        channel = connection.channel()
+        channel.queue_declare(queue=queue_name, durable=True)
+        
+        # A blocking channel in confirm mode waits for a broker ack after every
+        # publish; a transaction gets the whole batch acknowledged in one round trip
+        channel.tx_select()
+        try:
+            for message in messages:
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=queue_name,
+                    body=json.dumps(message),
+                    properties=pika.BasicProperties(delivery_mode=2)  # Make message persistent
+                )
+            channel.tx_commit()
+        except Exception:
+            if channel.is_open:
+                channel.tx_rollback()
+            raise
+        logger.info(f"Published {len(messages)} messages to queue '{queue_name}'")
+    finally:
+        if connection.is_open:
+            connection.close()
+
 @app.post("/upscale")
-async def upscale_image(file: UploadFile = File(...)):
+async def upscale_image(request: Request, background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     start_time = time.time()
+    job_type = job_type_for(file.filename, file.content_type, file.file)
+    if job_type == "video":
+        size = file.size if file.size is not None else file.file.seek(0, 2)
+        if size > Config.VIDEO_MAX_FILE_SIZE:
+            raise HTTPException(status_code=413, detail=f"Video exceeds {Config.VIDEO_MAX_FILE_SIZE} bytes")
+    admit_request(request)
     job_id = str(uuid.uuid4())
     
     logger.info(f"Starting upscale job {job_id} for file: {file.filename}")
     
     try:
         # Upload file to S3
-        file_content = await file.read()
         s3_input_key = f"input/{job_id}/{file.filename}"
         
         logger.info(f"Uploading file to S3: {s3_input_key}")
-        s3_client.put_object(
-            Bucket=Config.S3_INPUT_BUCKET,
-            Key=s3_input_key,
-            Body=file_content,
-            ContentType=file.content_type
-        )
+        if job_type == "video":
+            # Stream clips from the spooled upload in multipart chunks instead of reading them whole
+            file_content = None
+            await asyncio.get_running_loop().run_in_executor(s3_executor, partial(
+                s3_client.upload_fileobj,
+                rewound(file.file),
+                Config.S3_INPUT_BUCKET,
+                s3_input_key,
+                ExtraArgs={'ContentType': file.content_type}
+            ))
+        else:
+            file_content = await file.read()
+            s3_client.put_object(
+                Bucket=Config.S3_INPUT_BUCKET,
+                Key=s3_input_key,
+                Body=file_content,
+                ContentType=file.content_type
+            )
         logger.info(f"File uploaded to S3 successfully")
         
         # Send job to RabbitMQ queue
@@ -137,6 +243,7 @@ async def upscale_image(file: UploadFile = File(...)):
             "s3_input_key": s3_input_key,
             "filename": file.filename,
             "content_type": file.content_type,
+            "job_type": job_type,
             "created_at": time.time()
         }
         
@@ -153,6 +260,17 @@ async def upscale_image(file: UploadFile = File(...)):
         }))
         logger.info(f"Job {job_id} status set to 'queued' in Redis")
         
+        # Build a cheap preview while the full upscale waits for a worker (stills only)
+        preview_mode = Config.PREVIEW_MODE if job_payload["job_type"] == "image" else 'off'
+        if preview_mode == 'api':
+            background_tasks.add_task(generate_preview, job_payload, s3_client, redis_client, file_content)
+        elif preview_mode == 'consumer':
+            try:
+                publish_to_queue(job_payload, 'preview_jobs')
+            except Exception as e:
+                # The preview is best effort; the job itself is already queued
+                logger.warning(f"Failed to queue preview for job {job_id}: {e}")
+        
         return {
             "job_id": job_id,
             "status": "queued",
@@ -163,24 +281,271 @@ async def upscale_image(file: UploadFile = File(...)):
         logger.error(f"Upload error for job {job_id}: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
+@app.post("/upscale/batch")
+async def upscale_batch(request: Request, files: List[UploadFile] = File(...)):
+    """Submit many images (or ZIP archives of images) as one job group"""
+    group_id = str(uuid.uuid4())
+    created_at = time.time()
+    
+    # Size and count everything from the spooled uploads and ZIP directories before reading any content
+    archives = []
+    try:
+        try:
+            # (filename, content_type, size, job_type, open_source) for every file in the request
+            items = []
+            for file in files:
+                if is_zip_upload(file.filename, file.content_type):
+                    archive = zipfile.ZipFile(file.file)
+                    archives.append(archive)
+                    for name, entry, content_type in zip_image_entries(archive):
+                        items.append((name, content_type, entry.file_size, "image", partial(archive.open, entry)))
+                else:
+                    size = file.size if file.size is not None else file.file.seek(0, 2)
+                    if size > Config.BATCH_MAX_FILE_SIZE:
+                        raise ValueError(f"File '{file.filename}' exceeds the per-file size limit")
+                    job_type = job_type_for(file.filename, file.content_type, file.file)
+                    items.append((file.filename, file.content_type, size, job_type, partial(rewound, file.file)))
+        except (ValueError, zipfile.BadZipFile) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid batch upload: {str(e)}")
+        
+        if not items:
+            raise HTTPException(status_code=400, detail="Batch contains no images")
+        if len(items) > Config.BATCH_MAX_FILES:
+            raise HTTPException(status_code=413, detail=f"Batch exceeds {Config.BATCH_MAX_FILES} files")
+        if sum(size for _, _, size, _, _ in items) > Config.BATCH_MAX_TOTAL_SIZE:
+            raise HTTPException(status_code=413, detail=f"Batch exceeds {Config.BATCH_MAX_TOTAL_SIZE} bytes in total")
+        admit_request(request, cost=len(items))
+        
+        return await submit_batch(group_id, created_at, items)
+    finally:
+        for archive in archives:
+            archive.close()
+
+def upload_batch_input(job, open_source):
+    with open_source() as source:
+        s3_client.upload_fileobj(
+            source,
+            Config.S3_INPUT_BUCKET,
+            job["s3_input_key"],
+            ExtraArgs={'ContentType': job["content_type"]},
+            Config=batch_transfer_config
+        )
+
+async def submit_batch(group_id: str, created_at: float, items):
+    """Stream batch inputs to S3, record the group and publish its jobs"""
+    logger.info(f"Starting batch group {group_id} with {len(items)} files")
+    
+    jobs = []
+    for filename, content_type, _, job_type, _ in items:
+        job_id = str(uuid.uuid4())
+        jobs.append({
+            "job_id": job_id,
+            "group_id": group_id,
+            "s3_input_key": f"input/{job_id}/{filename}",
+            "filename": filename,
+            "content_type": content_type,
+            "job_type": job_type,
+            "created_at": created_at
+        })
+    
+    try:
+        # Stream all inputs to S3 concurrently; each transfer holds at most one chunk in memory
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(s3_executor, upload_batch_input, job, open_source)
+            for job, (_, _, _, _, open_source) in zip(jobs, items)
+        ])
+        logger.info(f"Uploaded {len(jobs)} inputs for group {group_id}")
+        
+        # Write group and job states in one round trip before the workers can see the jobs
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.setex(f"group:{group_id}", 3600, json.dumps({
+            "job_ids": [job["job_id"] for job in jobs],
+            "filenames": [job["filename"] for job in jobs],
+            "created_at": created_at
+        }))
+        for job in jobs:
+            pipeline.setex(f"job:{job['job_id']}", 3600, json.dumps({
+                "status": "queued",
+                "group_id": group_id,
+                "created_at": created_at
+            }))
+        pipeline.execute()
+        
+        try:
+            await loop.run_in_executor(None, publish_batch_to_queue, jobs, 'upscale_jobs')
+        except Exception:
+            pipeline = redis_client.pipeline(transaction=False)
+            for job in jobs:
+                pipeline.setex(f"job:{job['job_id']}", 3600, json.dumps({
+                    "status": "failed",
+                    "group_id": group_id,
+                    "error": "Failed to enqueue job",
+                    "failed_at": time.time()
+                }))
+            pipeline.execute()
+            raise
+        logger.info(f"Group {group_id} published to upscale_jobs queue")
+        
+        return {
+            "group_id": group_id,
+            "status": "queued",
+            "total_jobs": len(jobs),
+            "jobs": [{"job_id": job["job_id"], "input_file": job["filename"]} for job in jobs]
+        }
+        
+    except Exception as e:
+        logger.error(f"Batch upload error for group {group_id}: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Batch upload failed: {str(e)}")
+
+def load_group(group_id: str):
+    """Load a job group and the current state of each of its jobs"""
+    group_data = redis_client.get(f"group:{group_id}")
+    if not group_data:
+        raise HTTPException(status_code=404, detail="Group not found")
+    
+    group = json.loads(group_data)
+    job_ids = group["job_ids"]
+    job_states = [json.loads(state) if state else None
+                  for state in redis_client.mget([f"job:{job_id}" for job_id in job_ids])]
+    return group, job_states
+
+@app.get("/groups/{group_id}")
+async def get_group_status(group_id: str):
+    group, job_states = load_group(group_id)
+    status = aggregate_group_status(group["job_ids"], job_states)
+    for job, filename in zip(status["jobs"], group["filenames"]):
+        job["input_file"] = filename
+    
+    return {"group_id": group_id, "created_at": group["created_at"], **status}
+
+@app.get("/groups/{group_id}/download")
+async def download_group(group_id: str):
+    """Stream a ZIP archive of all completed outputs in a group"""
+    group, job_states = load_group(group_id)
+    
+    completed = [
+        (filename, state["output_key"])
+        for filename, state in zip(group["filenames"], job_states)
+        if state and state.get("status") == "completed" and state.get("output_key")
+    ]
+    if not completed:
+        raise HTTPException(status_code=404, detail="No completed outputs in group")
+    
+    def fetch_output(output_key):
+        return s3_client.get_object(Bucket=Config.S3_OUTPUT_BUCKET, Key=output_key)['Body'].read()
+    
+    def build_archive():
+        # Spill to disk for large groups instead of holding the whole archive in memory.
+        # Outputs are already-compressed JPEGs, so store them without deflate.
+        archive_file = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+        used_names = set()
+        window = Config.BATCH_UPLOAD_CONCURRENCY
+        with zipfile.ZipFile(archive_file, 'w', compression=zipfile.ZIP_STORED) as archive:
+            # Fetch one window of outputs concurrently at a time to bound memory use
+            for start in range(0, len(completed), window):
+                chunk = completed[start:start + window]
+                contents = s3_executor.map(fetch_output, [output_key for _, output_key in chunk])
+                for (filename, output_key), content in zip(chunk, contents):
+                    archive.writestr(unique_archive_name(filename, output_key, used_names), content)
+        archive_file.seek(0)
+        return archive_file
+    
+    try:
+        archive_file = await asyncio.get_running_loop().run_in_executor(None, build_archive)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"File not found: {str(e)}")
+    
+    def iter_archive():
+        try:
+            while True:
+                chunk = archive_file.read(1024 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            archive_file.close()
+    
+    return StreamingResponse(
+        iter_archive(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="upscaled_{group_id}.zip"'}
+    )
+
 @app.get("/status/{job_id}")
 async def get_job_status(job_id: str):
     try:
-        status_data = redis_client.get(f"job:{job_id}")
+        status_data, preview_data = redis_client.mget(f"job:{job_id}", f"preview:{job_id}")
         if not status_data:
             raise HTTPException(status_code=404, detail="Job not found")
         
-        return json.loads(status_data)
+        status = json.loads(status_data)
+        status["preview_ready"] = bool(preview_data) and json.loads(preview_data).get("status") == "ready"
+        return status
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Status check failed: {str(e)}")
 
+@app.post("/cancel/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job"""
+    status_data = redis_client.get(f"job:{job_id}")
+    if not status_data:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    status = json.loads(status_data).get("status")
+    if status in ("completed", "failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Job already {status}")
+    
+    try:
+        # The flag lets the worker skip the job at dequeue time and survives the
+        # worker's progress updates; the publish interrupts a job that is running
+        pipeline = redis_client.pipeline()
+        pipeline.setex(f"job:{job_id}:cancelled", 3600, 1)
+        pipeline.setex(f"job:{job_id}", 3600, json.dumps({
+            "status": "cancelled",
+            "cancelled_at": time.time()
+        }))
+        pipeline.publish("job_cancellations", job_id)
+        pipeline.execute()
+        logger.info(f"Job {job_id} cancelled (was {status})")
+        
+        return {"job_id": job_id, "status": "cancelled"}
+        
+    except Exception as e:
+        logger.error(f"Failed to cancel job {job_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Cancel failed: {str(e)}")
+
+@app.get("/preview/{job_id}")
+async def download_preview(job_id: str):
+    """Presigned URL for the fast preview, available before the full upscale finishes"""
+    preview_data = redis_client.get(f"preview:{job_id}")
+    if not preview_data:
+        raise HTTPException(status_code=404, detail="Preview not ready")
+    
+    preview = json.loads(preview_data)
+    if preview.get("status") != "ready":
+        raise HTTPException(status_code=404, detail=f"Preview {preview.get('status')}: {preview.get('error', '')}")
+    
+    download_url = presign_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': Config.S3_OUTPUT_BUCKET, 'Key': preview["preview_key"]},
+        ExpiresIn=3600  # 1 hour
+    )
+    
+    return {"preview_url": download_url}
+
 @app.get("/download/{job_id}")
 async def download_upscaled_image(job_id: str):
     try:
-        output_key = f"output/{job_id}/upscaled.jpg"
+        # Video jobs record their own output key (.mp4/.gif); images are always JPEG
+        status_data = redis_client.get(f"job:{job_id}")
+        status = json.loads(status_data) if status_data else {}
+        output_key = status.get("output_key") or f"output/{job_id}/upscaled.jpg"
         
         # Generate presigned URL for download
-        download_url = s3_client.generate_presigned_url(
+        download_url = presign_client.generate_presigned_url(
             'get_object',
             Params={'Bucket': Config.S3_OUTPUT_BUCKET, 'Key': output_key},
             ExpiresIn=3600  # 1 hour
@@ -226,7 +591,7 @@ async def list_queues():
         
         # Get queue info for known queues
         queues_info = []
-        known_queues = ['upscale_jobs', 'analytics_events']
+        known_queues = ['upscale_jobs', 'preview_jobs', 'analytics_events']
         
         for queue_name in known_queues:
             try:
@@ -258,7 +623,7 @@ async def clear_all_queues():
         connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
         channel = connection.channel()
         
-        known_queues = ['upscale_jobs', 'analytics_events']
+        known_queues = ['upscale_jobs', 'preview_jobs', 'analytics_events']
         results = []
         total_cleared = 0
         
@@ -0,0 +1,104 @@
+import mimetypes
+import os
+import zipfile
+from PIL import Image
+from config import Config
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.m4v', '.webm', '.mkv', '.avi')
+
+def is_animated_gif(fileobj) -> bool:
+    """Check for a multi-frame GIF without decoding it, leaving the stream position unchanged"""
+    position = fileobj.tell()
+    try:
+        fileobj.seek(0)
+        with Image.open(fileobj) as image:
+            return getattr(image, 'is_animated', False)
+    except Exception:
+        return False
+    finally:
+        fileobj.seek(position)
+
+def job_type_for(filename: str, content_type: str, fileobj=None) -> str:
+    """Route clips and animated GIFs to the streaming video pipeline, everything else to the image one"""
+    name = (filename or '').lower()
+    if content_type == 'image/gif' or name.endswith('.gif'):
+        # Still GIFs keep the image path (full-size JPEG output)
+        return "video" if fileobj is not None and is_animated_gif(fileobj) else "image"
+    if (content_type or '').startswith('video/') or name.endswith(VIDEO_EXTENSIONS):
+        return "video"
+    return "image"
+
+def is_zip_upload(filename: str, content_type: str) -> bool:
+    """Check whether an uploaded file is a ZIP archive of images"""
+    return (content_type in ('application/zip', 'application/x-zip-compressed')
+            or (filename or '').lower().endswith('.zip'))
+
+def rewound(fileobj):
+    """Seek a spooled upload back to the start before streaming it"""
+    fileobj.seek(0)
+    return fileobj
+
+def zip_image_entries(archive: zipfile.ZipFile):
+    """List the image entries of a ZIP archive as (filename, ZipInfo, content_type), without reading them"""
+    entries = []
+    for entry in archive.infolist():
+        name = os.path.basename(entry.filename)
+        # Skip directories, hidden files and macOS resource forks
+        if entry.is_dir() or not name or name.startswith('.') or '__MACOSX' in entry.filename:
+            continue
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if entry.file_size > Config.BATCH_MAX_FILE_SIZE:
+            raise ValueError(f"Archive entry '{entry.filename}' exceeds the per-file size limit")
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        entries.append((name, entry, content_type))
+    return entries
+
+def aggregate_group_status(job_ids, job_states):
+    """Combine per-job Redis states into a single group status"""
+    counts = {"queued": 0, "processing": 0, "completed": 0, "failed": 0, "cancelled": 0, "expired": 0}
+    jobs = []
+    total_progress = 0
+
+    for job_id, state in zip(job_ids, job_states):
+        status = state.get("status", "expired") if state else "expired"
+        counts[status] = counts.get(status, 0) + 1
+        if status == "completed":
+            progress = 100
+        else:
+            progress = state.get("progress", 0) if state else 0
+        total_progress += progress
+        jobs.append({"job_id": job_id, "status": status, "progress": progress})
+
+    pending = counts["queued"] + counts["processing"]
+    if pending:
+        group_status = "processing" if counts["processing"] or counts["completed"] else "queued"
+    elif counts["completed"] == len(job_ids):
+        group_status = "completed"
+    elif counts["completed"]:
+        group_status = "partially_completed"
+    elif counts["cancelled"] == len(job_ids):
+        group_status = "cancelled"
+    else:
+        group_status = "failed"
+
+    return {
+        "status": group_status,
+        "progress": round(total_progress / len(job_ids)) if job_ids else 0,
+        "total_jobs": len(job_ids),
+        "counts": counts,
+        "jobs": jobs
+    }
+
+def unique_archive_name(filename: str, output_key: str, used_names: set) -> str:
+    """Build a unique '<stem>_upscaled<ext>' name for an entry in the combined download"""
+    stem = os.path.splitext(os.path.basename(filename))[0] or "image"
+    extension = os.path.splitext(output_key)[1] or ".jpg"
+    name = f"{stem}_upscaled{extension}"
+    suffix = 1
+    while name in used_names:
+        name = f"{stem}_upscaled_{suffix}{extension}"
+        suffix += 1
+    used_names.add(name)
+    return name
@@ -1,9 +1,12 @@
 
 import os
+import json
 
 class Config:
     # AWS/S3 Configuration - only use endpoint_url for local development
-    AWS_ENDPOINT_URL = os.getenv('AWS_ENDPOINT_URL') if os.getenv('AWS_ENDPOINT_URL', '').startswith('http://localhost') else None
+    AWS_ENDPOINT_URL = os.getenv('AWS_ENDPOINT_URL') if os.getenv('AWS_ENDPOINT_URL', '').startswith(('http://localhost', 'http://localstack')) else None
+    # Endpoint the browser can reach for presigned URLs when AWS_ENDPOINT_URL is a container hostname
+    AWS_PUBLIC_ENDPOINT_URL = os.getenv('AWS_PUBLIC_ENDPOINT_URL') if AWS_ENDPOINT_URL else None
     AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID', 'test')
     AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY', 'test')
     AWS_DEFAULT_REGION = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
@@ -12,6 +15,46 @@ class Config:
     S3_INPUT_BUCKET = os.getenv('S3_INPUT_BUCKET', 'ai-upscaler-input')
     S3_OUTPUT_BUCKET = os.getenv('S3_OUTPUT_BUCKET', 'ai-upscaler-output')
     S3_MODELS_BUCKET = os.getenv('S3_MODELS_BUCKET', 'ai-upscaler-models')
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', '32'))
+    
+    # Batch submission limits
+    BATCH_MAX_FILES = int(os.getenv('BATCH_MAX_FILES', '500'))
+    BATCH_MAX_FILE_SIZE = int(os.getenv('BATCH_MAX_FILE_SIZE', str(50 * 1024 * 1024)))
+    BATCH_MAX_TOTAL_SIZE = int(os.getenv('BATCH_MAX_TOTAL_SIZE', str(512 * 1024 * 1024)))
+    BATCH_UPLOAD_CONCURRENCY = int(os.getenv('BATCH_UPLOAD_CONCURRENCY', '16'))
+    
+    # Video clips and animated GIFs on /upscale are streamed to S3, up to this size
+    VIDEO_MAX_FILE_SIZE = int(os.getenv('VIDEO_MAX_FILE_SIZE', str(500 * 1024 * 1024)))
+    
+    # Preview tier: 'api' builds previews in the API process, 'consumer' hands
+    # them to preview_worker.py through the preview_jobs queue, 'off' disables them
+    PREVIEW_MODE = os.getenv('PREVIEW_MODE', 'api')
+    PREVIEW_PREFETCH = int(os.getenv('PREVIEW_PREFETCH', '4'))
+    # Must match the upscaler service's MAX_INPUT_DIMENSION so previews have the final output's size
+    MAX_INPUT_DIMENSION = int(os.getenv('MAX_INPUT_DIMENSION', '512'))
+    
+    # Admission control: per-tier token buckets (capacity, refill_per_second) and the
+    # longest estimated queue wait a tier accepts; keep waits well under the 3600s job TTL
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_TIERS = json.loads(os.getenv('ADMISSION_TIERS', json.dumps({
+        "anonymous": {"capacity": 60, "refill_per_second": 60 / 1800, "max_queue_wait_seconds": 1800},
+        "free": {"capacity": 20, "refill_per_second": 20 / 3600, "max_queue_wait_seconds": 900},
+        "pro": {"capacity": 500, "refill_per_second": 1.0, "max_queue_wait_seconds": 1800}
+    })))
+    ADMISSION_DEFAULT_TIER = os.getenv('ADMISSION_DEFAULT_TIER', 'free')
+    # Token buckets and tiers apply only to X-User-Id values signed by the auth gateway
+    # (X-User-Signature = hex HMAC-SHA256 of the id); everyone else gets the anonymous
+    # tier, with one token bucket per client IP
+    ADMISSION_IDENTITY_SECRET = os.getenv('ADMISSION_IDENTITY_SECRET', '')
+    ADMISSION_ANONYMOUS_TIER = os.getenv('ADMISSION_ANONYMOUS_TIER', 'anonymous')
+    ADMISSION_QUEUE_CACHE_SECONDS = float(os.getenv('ADMISSION_QUEUE_CACHE_SECONDS', '2'))
+    ADMISSION_DRAIN_WINDOW_MINUTES = int(os.getenv('ADMISSION_DRAIN_WINDOW_MINUTES', '5'))
+    ADMISSION_EST_JOB_SECONDS = float(os.getenv('ADMISSION_EST_JOB_SECONDS', '30'))
+    ADMISSION_NO_CONSUMER_RETRY_SECONDS = int(os.getenv('ADMISSION_NO_CONSUMER_RETRY_SECONDS', '60'))
+    
+    # On-demand profiling under /debug/profile; the endpoints 404 unless a token is set
+    DEBUG_TOKEN = os.getenv('DEBUG_TOKEN', '')
+    DEBUG_PROFILE_MAX_SECONDS = float(os.getenv('DEBUG_PROFILE_MAX_SECONDS', '120'))
     
     # Upscaler Service
     UPSCALER_SERVICE_URL = os.getenv('UPSCALER_SERVICE_URL', 'http://upscaler-service:8083')
@@ -26,6 +26,12 @@ analytics_events_processed_total = Counter(
     ['event_type', 'status']
 )
 
+admission_rejections_total = Counter(
+    'admission_rejections_total',
+    'Upscale requests rejected by admission control',
+    ['tier', 'reason']
+)
+
 class MetricsCollector:
     @staticmethod
     def record_api_request(method: str, endpoint: str, duration: float, status: int):
@@ -36,6 +42,10 @@ class MetricsCollector:
     def record_file_upload(file_type: str):
         file_uploads_total.labels(file_type=file_type).inc()
     
+    @staticmethod
+    def record_admission_rejection(tier: str, reason: str):
+        admission_rejections_total.labels(tier=tier, reason=reason).inc()
+    
     @staticmethod
     def record_analytics_event(event_type: str, status: str = "success"):
         analytics_events_processed_total.labels(event_type=event_type, status=status).inc()
@@ -0,0 +1,72 @@
+import io
+import json
+import time
+import logging
+from PIL import Image, ImageFilter
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Mirror the worker's geometry so the preview matches the final output size
+PREVIEW_SCALE = 4
+
+def build_preview(image_data: bytes) -> bytes:
+    """Cheap stand-in for the full upscale: bicubic 4x plus unsharp mask"""
+    max_dimension = Config.MAX_INPUT_DIMENSION
+    image = Image.open(io.BytesIO(image_data))
+    image.draft('RGB', (max_dimension, max_dimension))  # Fast JPEG downscale on decode
+
+    if max(image.size) > max_dimension:
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.BILINEAR)
+
+    # Flatten alpha onto white like the worker does
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    width, height = image.size
+    preview = image.resize((width * PREVIEW_SCALE, height * PREVIEW_SCALE), Image.Resampling.BICUBIC)
+    preview = preview.filter(ImageFilter.UnsharpMask(radius=2, percent=120, threshold=3))
+
+    output_buffer = io.BytesIO()
+    preview.save(output_buffer, format='JPEG', quality=80, progressive=True)
+    return output_buffer.getvalue()
+
+def preview_key(job_id: str) -> str:
+    return f"output/{job_id}/preview.jpg"
+
+def generate_preview(job: dict, s3_client, redis_client, image_data: bytes = None):
+    """Build a preview for a job, store it next to the job output and mark it ready"""
+    job_id = job["job_id"]
+    start_time = time.time()
+    try:
+        if image_data is None:
+            image_data = s3_client.get_object(
+                Bucket=Config.S3_INPUT_BUCKET,
+                Key=job["s3_input_key"]
+            )['Body'].read()
+
+        s3_client.put_object(
+            Bucket=Config.S3_OUTPUT_BUCKET,
+            Key=preview_key(job_id),
+            Body=build_preview(image_data),
+            ContentType='image/jpeg'
+        )
+
+        redis_client.setex(f"preview:{job_id}", 3600, json.dumps({
+            "status": "ready",
+            "preview_key": preview_key(job_id),
+            "ready_at": time.time()
+        }))
+        logger.info(f"Preview for job {job_id} ready in {time.time() - start_time:.3f}s")
+    except Exception as e:
+        logger.warning(f"Preview generation failed for job {job_id}: {e}")
+        redis_client.setex(f"preview:{job_id}", 3600, json.dumps({
+            "status": "failed",
+            "error": str(e)
+        }))
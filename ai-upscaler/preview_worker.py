@@ -0,0 +1,51 @@
+import json
+import logging
+import boto3
+import pika
+import redis
+from config import Config
+from preview import generate_preview
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Initialize AWS clients
+s3_client_config = {
+    'aws_access_key_id': Config.AWS_ACCESS_KEY_ID,
+    'aws_secret_access_key': Config.AWS_SECRET_ACCESS_KEY,
+    'region_name': Config.AWS_DEFAULT_REGION
+}
+
+# Only use endpoint_url for local development
+if Config.AWS_ENDPOINT_URL:
+    s3_client_config['endpoint_url'] = Config.AWS_ENDPOINT_URL
+
+s3_client = boto3.client('s3', **s3_client_config)
+redis_client = redis.from_url(Config.REDIS_URL)
+
+def process_preview_job(ch, method, properties, body):
+    """Build the preview for one job; failures are recorded, never retried"""
+    try:
+        job = json.loads(body)
+        generate_preview(job, s3_client, redis_client)
+    except Exception as e:
+        logger.error(f"Invalid preview job: {e}", exc_info=True)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+def main():
+    """Lightweight consumer for preview_jobs, for when previews are kept off the API tier"""
+    logger.info(f"Attempting to connect to RabbitMQ: {Config.RABBITMQ_URL}")
+    connection = pika.BlockingConnection(pika.URLParameters(Config.RABBITMQ_URL))
+    channel = connection.channel()
+    channel.queue_declare(queue='preview_jobs', durable=True)
+    channel.basic_qos(prefetch_count=Config.PREVIEW_PREFETCH)
+    channel.basic_consume(queue='preview_jobs', on_message_callback=process_preview_job, auto_ack=False)
+    logger.info("Preview consumer ready. Waiting for preview jobs...")
+    channel.start_consuming()
+
+if __name__ == "__main__":
+    main()
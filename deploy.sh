@@ -32,13 +32,13 @@ aws ecr create-repository --repository-name rabbitai-upscaler-service --region $
 
 # Build and push AI Upscaler API
 echo "Building and pushing AI Upscaler API..."
-docker build -t ai-upscaler-api ./ai-upscaler
+docker build --build-context shared=./shared -t ai-upscaler-api ./ai-upscaler
 docker tag ai-upscaler-api:latest ${ECR_REGISTRY}/rabbitai-ai-upscaler-api:latest
 docker push ${ECR_REGISTRY}/rabbitai-ai-upscaler-api:latest
 
 # Build and push Upscaler Service
 echo "Building and pushing Upscaler Service..."
-docker build -t upscaler-service ./upscaler-service
+docker build --build-context shared=./shared -t upscaler-service ./upscaler-service
 docker tag upscaler-service:latest ${ECR_REGISTRY}/rabbitai-upscaler-service:latest
 docker push ${ECR_REGISTRY}/rabbitai-upscaler-service:latest
 
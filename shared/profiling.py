@@ -0,0 +1,195 @@
+"""On-demand profiling endpoints shared by the API and the upscaler service.
+
+Lives outside both services and is copied into each image from the `shared`
+build context (see docker-compose.yml and deploy.sh), so the two /debug/profile
+implementations can't drift apart. Service-specific profilers (the worker's
+torch traces) add their own routes next to create_router().
+"""
+import os
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import tempfile
+import threading
+import tracemalloc
+from collections import Counter
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import Response
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Nothing here runs until an endpoint is called: no sampler thread, no tracemalloc hooks
+_cpu_lock = threading.Lock()
+_memory_lock = threading.Lock()
+
+
+def require_debug_token(x_debug_token: str = Header(None)):
+    """Debug endpoints don't exist without DEBUG_TOKEN, and need it in X-Debug-Token when they do"""
+    if not Config.DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_debug_token or not hmac.compare_digest(x_debug_token, Config.DEBUG_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid debug token")
+
+
+def short_path(filename):
+    """Package-relative path for installed modules, basename for everything else"""
+    for marker in ('site-packages/', 'dist-packages/'):
+        if marker in filename:
+            return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+def frame_label(code):
+    """Function name plus short file location; ';' is the folded-stack separator"""
+    return f"{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+# Innermost Python frames of threads parked in a blocking call (lock, select, socket read,
+# idle executor). Like py-spy's default, /cpu drops these samples so idle pika, pub/sub and
+# executor threads don't bury the hot path; time.sleep and other C waits can't be told apart
+IDLE_FRAMES = {
+    'threading.py': {'wait', '_wait_for_tstate_lock'},
+    'selectors.py': {'select'},
+    'socket.py': {'accept', 'readinto'},
+    'ssl.py': {'read', 'recv', 'recv_into'},
+    'concurrent/futures/thread.py': {'_worker'},
+    'pika/adapters/select_connection.py': {'poll'},
+    'redis/_parsers/socket.py': {'_read_from_socket'},
+}
+
+
+def is_idle(frame):
+    filename = frame.f_code.co_filename.replace(os.sep, '/')
+    return any(frame.f_code.co_name in names and (filename == suffix or filename.endswith('/' + suffix))
+               for suffix, names in IDLE_FRAMES.items())
+
+
+def sample_cpu(seconds, interval, include_idle=False):
+    """Sample the Python stack of every other thread; returns folded stack -> sample count.
+
+    Threads blocked in a known wait (IDLE_FRAMES) are skipped unless
+    include_idle, which turns the profile into a wall-clock one.
+    """
+    own_ident = threading.get_ident()
+    counts = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or (not include_idle and is_idle(frame)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(f"thread:{names.get(ident, ident)}")
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return counts
+
+
+def capture_allocations(seconds, frames):
+    """Trace allocations for `seconds` and snapshot what is still alive.
+
+    tracemalloc is only switched on for the window, unless something else
+    (e.g. PYTHONTRACEMALLOC) already had it running.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+
+
+def format_allocations(snapshot, output_format, limit):
+    if output_format == "snapshot":
+        # Raw dump for offline analysis: tracemalloc.Snapshot.load(path)
+        fd, path = tempfile.mkstemp(suffix='.tracemalloc')
+        os.close(fd)
+        try:
+            snapshot.dump(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+    if output_format == "folded":
+        # Live bytes per allocation stack, oldest frame first, for flamegraph.pl / speedscope
+        lines = []
+        for stat in snapshot.statistics('traceback'):
+            stack = ';'.join(f"{short_path(frame.filename)}:{frame.lineno}".replace(';', ':') for frame in stat.traceback)
+            lines.append(f"{stack} {stat.size}")
+        return ('\n'.join(lines) + '\n').encode()
+
+    stats = snapshot.statistics('lineno')
+    lines = [f"Live allocations: {sum(stat.size for stat in stats) / 1024:.1f} KiB in {sum(stat.count for stat in stats)} blocks",
+             f"Top {min(limit, len(stats))} lines by size:"]
+    lines.extend(str(stat) for stat in stats[:limit])
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def artifact(content, filename, media_type):
+    return Response(content=content, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+def create_router(service):
+    """/debug/profile/cpu and /memory, with artifacts named after `service` (api, worker)"""
+    router = APIRouter(prefix="/debug/profile", dependencies=[Depends(require_debug_token)], include_in_schema=False)
+
+    @router.get("/cpu")
+    async def profile_cpu(
+        seconds: float = Query(10, gt=0, le=Config.DEBUG_PROFILE_MAX_SECONDS),
+        interval_ms: float = Query(10, ge=1, le=1000),
+        idle: bool = Query(False)
+    ):
+        """Sampling profile of all busy threads as folded stacks (flamegraph.pl, speedscope);
+        idle=true keeps threads parked in blocking waits (wall-clock profile)"""
+        if not _cpu_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="A CPU profile is already running")
+        try:
+            logger.info(f"CPU profile started for {seconds}s at {interval_ms}ms (idle={idle})")
+            # Sample from a worker thread so the event loop keeps serving (and being profiled)
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(None, sample_cpu, seconds, interval_ms / 1000, idle)
+        finally:
+            _cpu_lock.release()
+
+        content = ''.join(f"{stack} {count}\n" for stack, count in counts.most_common()).encode()
+        return artifact(content, f"{service}-cpu-{int(time.time())}.folded", "text/plain")
+
+    @router.get("/memory")
+    async def profile_memory(
+        seconds: float = Query(10, ge=0, le=Config.DEBUG_PROFILE_MAX_SECONDS),
+        frames: int = Query(16, ge=1, le=64),
+        format: str = Query("text", pattern="^(text|folded|snapshot)$"),
+        limit: int = Query(50, ge=1, le=1000)
+    ):
+        """tracemalloc snapshot of allocations made during the window and still alive at its end"""
+        if not _memory_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="An allocation capture is already running")
+        try:
+            logger.info(f"Allocation capture started for {seconds}s ({frames} frames)")
+            loop = asyncio.get_running_loop()
+            snapshot = await loop.run_in_executor(None, capture_allocations, seconds, frames)
+            content = await loop.run_in_executor(None, format_allocations, snapshot, format, limit)
+        finally:
+            _memory_lock.release()
+
+        extension = {"text": "txt", "folded": "folded", "snapshot": "tracemalloc"}[format]
+        media_type = "application/octet-stream" if format == "snapshot" else "text/plain"
+        return artifact(content, f"{service}-memory-{int(time.time())}.{extension}", media_type)
+
+    return router
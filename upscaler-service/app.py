@@ -1,20 +1,26 @@
 from fastapi import FastAPI, HTTPException
-import boto3
 from PIL import Image
 import io
 import numpy as np
 import cv2
-from realesrgan import RealESRGANer
 from basicsr.archs.rrdbnet_arch import RRDBNet
 import json
 import pika
 import redis
 import threading
 from config import Config
+from s3_transfer import S3Transfer, create_s3_client
+from inference import TiledUpsampler
+from autotune import autotune
+from weights import load_shared_weights
+from video import upscale_video
+from profiling import create_router as create_profiling_router
+from torch_profiling import router as torch_profiling_router, torch_capture
+from cancellation import CancellationWatcher, JobCancelled
 import time
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # Configure logging
 logging.basicConfig(
@@ -43,19 +49,11 @@ app.add_middleware(
 )
 
 # Initialize clients
-s3_client_config = {
-    'aws_access_key_id': Config.AWS_ACCESS_KEY_ID,
-    'aws_secret_access_key': Config.AWS_SECRET_ACCESS_KEY,
-    'region_name': Config.AWS_DEFAULT_REGION
-}
-
-# Only use endpoint_url for local development
-if Config.AWS_ENDPOINT_URL and 'localhost' in Config.AWS_ENDPOINT_URL:
-    s3_client_config['endpoint_url'] = Config.AWS_ENDPOINT_URL
-
-s3_client = boto3.client('s3', **s3_client_config)
+s3_client = create_s3_client()
+s3_transfer = S3Transfer(s3_client)
 
 redis_client = redis.from_url(Config.REDIS_URL)
+cancellations = CancellationWatcher(redis_client)
 
 # Create a thread pool for CPU-intensive tasks
 executor = ThreadPoolExecutor(max_workers=2)
@@ -65,7 +63,15 @@ def load_realesrgan_model():
     model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
     model_path = '/app/weights/RealESRGAN_x4plus.pth'
     
-    upsampler = RealESRGANer(
+    if Config.MMAP_WEIGHTS_ENABLED:
+        try:
+            # Parameters become views of a read-only mmap shared by all workers on the host
+            load_shared_weights(model, model_path)
+            model_path = None
+        except Exception as e:
+            logger.warning(f"Memory-mapped weights unavailable, falling back to torch.load: {e}")
+    
+    upsampler = TiledUpsampler(
         scale=4,
         model_path=model_path,
         model=model,
@@ -97,11 +103,20 @@ def warm_up_model():
 # Warm up model at startup
 print("Warming up model for faster processing...")
 warm_up_model()
+
+# Pick tile size and thread count for this node (cached per hardware fingerprint)
+print("Autotuning tile size and thread count...")
+tuned_settings = autotune(upsampler)
 print("Model ready for processing!")
 
+# Token-protected /debug/profile endpoints (CPU sampling, tracemalloc, torch traces)
+upsampler.trace_capture = torch_capture
+app.include_router(create_profiling_router("worker"))
+app.include_router(torch_profiling_router)
+
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "model": "Real-ESRGAN x4"}
+    return {"status": "healthy", "model": "Real-ESRGAN x4", "tuning": tuned_settings}
 
 def setup_rabbitmq_consumer():
     """Setup RabbitMQ consumer for upscale jobs"""
@@ -112,6 +127,9 @@ def setup_rabbitmq_consumer():
         channel.queue_declare(queue='upscale_jobs', durable=True)
         logger.info("Successfully declared upscale_jobs queue")
         
+        # One job at a time: long video jobs service heartbeats from inside the callback
+        channel.basic_qos(prefetch_count=1)
+        
         channel.basic_consume(
             queue='upscale_jobs',
             on_message_callback=process_upscale_job,
@@ -126,95 +144,50 @@ def setup_rabbitmq_consumer():
 def process_upscale_job(ch, method, properties, body):
     """Process upscale job from queue with optimizations"""
     logger.info(f"Received message: {body}")
+    job_id = None
     try:
         job_data = json.loads(body)
         job_id = job_data['job_id']
+        
+        # Skip jobs that were cancelled while they sat in the queue
+        if cancellations.is_cancelled(job_id):
+            logger.info(f"Skipping cancelled job {job_id}")
+            cleanup_cancelled_job(job_data)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        
         logger.info(f"Processing job {job_id}")
+        cancel_event = cancellations.watch(job_id)
         
         # Update status to processing with progress
-        def update_progress(progress, stage):
+        def update_progress(progress, stage, **extra):
+            # The flag catches cancels whose pub/sub message was missed (e.g. during a reconnect)
+            if not cancel_event.is_set() and cancellations.is_cancelled(job_id):
+                cancel_event.set()
+            if cancel_event.is_set():
+                raise JobCancelled(f"Job cancelled before: {stage}")
             logger.info(f"Job {job_id}: {stage} - {progress}%")
             redis_client.setex(f"job:{job_id}", 3600, json.dumps({
                 "status": "processing",
                 "progress": progress,
                 "stage": stage,
-                "started_at": time.time()
+                "started_at": time.time(),
+                **extra
             }))
         
-        update_progress(10, "Downloading image")
-        
-        # Download image from S3
-        response = s3_client.get_object(
-            Bucket=Config.S3_INPUT_BUCKET,
-            Key=job_data['s3_input_key']
-        )
-        
-        update_progress(30, "Loading and optimizing image")
-        
-        # Load and process image with optimizations
-        image_data = response['Body'].read()
-        image = Image.open(io.BytesIO(image_data))
+        if job_data.get('job_type') == 'video':
+            output_key, original_size, extra_status = process_video_job(ch, job_data, update_progress, cancel_event)
+        else:
+            output_key, original_size = process_image_job(job_data, update_progress, cancel_event)
+            extra_status = {}
         
-        # Aggressive resizing for small instances
-        max_dimension = 512  # Reduced from 1024 for faster processing
-        original_size = image.size
-        
-        if max(image.size) > max_dimension:
-            logger.info(f"Resizing large image from {image.size} to max {max_dimension}")
-            # Use faster resampling method
-            image.thumbnail((max_dimension, max_dimension), Image.Resampling.BILINEAR)
-            update_progress(40, "Resized for faster processing")
-        
-        # Convert to RGB if needed (remove alpha channel)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-            update_progress(45, "Optimized image format")
-        
-        # Convert to OpenCV format
-        img_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-        
-        update_progress(50, "AI upscaling (optimized)")
-        logger.info(f"Starting optimized AI upscaling for image size: {img_cv.shape}")
-        
-        # Use optimized upscaling with smaller chunks
-        def upscale_task():
-            # Process in smaller chunks for memory efficiency
-            height, width = img_cv.shape[:2]
-            if height * width > 256 * 256:  # If image is large, process in chunks
-                logger.info("Processing large image in chunks for memory efficiency")
-                return upsampler.enhance(img_cv, outscale=4)
-            else:
-                return upsampler.enhance(img_cv, outscale=4)
-        
-        future = executor.submit(upscale_task)
-        output, _ = future.result(timeout=180)  # Reduced timeout to 3 minutes
-        logger.info("Optimized AI upscaling completed")
-        
-        update_progress(80, "Converting result")
-        
-        # Convert and save with optimized quality
-        upscaled_rgb = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
-        upscaled = Image.fromarray(upscaled_rgb)
-        
-        output_buffer = io.BytesIO()
-        # Use progressive JPEG for faster loading
-        upscaled.save(output_buffer, format='JPEG', quality=90, optimize=True, progressive=True)
-        output_buffer.seek(0)
-        
-        update_progress(95, "Uploading result")
-        
-        # Upload to output bucket
-        output_key = f"output/{job_id}/upscaled.jpg"
-        s3_client.put_object(
-            Bucket=Config.S3_OUTPUT_BUCKET,
-            Key=output_key,
-            Body=output_buffer.getvalue(),
-            ContentType='image/jpeg'
-        )
+        # Don't overwrite the API's cancelled state with a late completion
+        if cancellations.is_cancelled(job_id):
+            try:
+                s3_client.delete_object(Bucket=Config.S3_OUTPUT_BUCKET, Key=output_key)
+            except Exception as e:
+                logger.warning(f"Failed to delete output for cancelled job {job_id}: {e}")
+            raise JobCancelled("Job cancelled before completion")
         
         # Update status to completed
         redis_client.setex(f"job:{job_id}", 3600, json.dumps({
@@ -223,12 +196,18 @@ def process_upscale_job(ch, method, properties, body):
             "output_key": output_key,
             "completed_at": time.time(),
             "original_size": original_size,
-            "processing_time": time.time() - job_data.get('started_at', time.time())
+            "processing_time": time.time() - job_data.get('started_at', time.time()),
+            **extra_status
         }))
         
         logger.info(f"Job {job_id} completed successfully")
         ch.basic_ack(delivery_tag=method.delivery_tag)
         
+    except JobCancelled as e:
+        logger.info(f"Job {job_id} cancelled: {e}")
+        cleanup_cancelled_job(job_data)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        
     except Exception as e:
         logger.error(f"Error processing job: {e}", exc_info=True)
         redis_client.setex(f"job:{job_id}", 3600, json.dumps({
@@ -237,6 +216,161 @@ def process_upscale_job(ch, method, properties, body):
             "failed_at": time.time()
         }))
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    
+    finally:
+        if job_id:
+            cancellations.unwatch(job_id)
+        record_drained()
+
+def record_drained():
+    """Count handled messages per minute; the API derives the queue drain rate from these"""
+    try:
+        key = f"stats:drained:{int(time.time() // 60)}"
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.incr(key)
+        pipeline.expire(key, 3600)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record drain stats: {e}")
+
+def process_image_job(job_data, update_progress, cancel_event):
+    """Download, upscale and upload a still image; returns (output_key, original_size)"""
+    job_id = job_data['job_id']
+    
+    update_progress(10, "Downloading image")
+    
+    # Download image from S3 (concurrent ranged GETs for large inputs)
+    image_data = s3_transfer.download_bytes(Config.S3_INPUT_BUCKET, job_data['s3_input_key'])
+    
+    update_progress(30, "Loading and optimizing image")
+    
+    # Load and process image with optimizations
+    image = Image.open(io.BytesIO(image_data))
+    
+    # Aggressive resizing for small instances
+    max_dimension = Config.MAX_INPUT_DIMENSION  # Reduced from 1024 for faster processing
+    original_size = image.size
+    
+    if max(image.size) > max_dimension:
+        logger.info(f"Resizing large image from {image.size} to max {max_dimension}")
+        # Use faster resampling method
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.BILINEAR)
+        update_progress(40, "Resized for faster processing")
+    
+    # Convert to RGB if needed (remove alpha channel)
+    if image.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        if image.mode == 'P':
+            image = image.convert('RGBA')
+        background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
+        image = background
+        update_progress(45, "Optimized image format")
+    
+    # Convert to OpenCV format
+    img_cv = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    
+    update_progress(50, "AI upscaling (optimized)")
+    logger.info(f"Starting optimized AI upscaling for image size: {img_cv.shape}")
+    
+    # Use optimized upscaling with smaller chunks
+    def upscale_task():
+        # The tile loop checks this event between tiles (held per executor thread)
+        upsampler.cancel_event = cancel_event
+        try:
+            # Process in smaller chunks for memory efficiency
+            height, width = img_cv.shape[:2]
+            if height * width > 256 * 256:  # If image is large, process in chunks
+                logger.info("Processing large image in chunks for memory efficiency")
+                return upsampler.enhance(img_cv, outscale=4)
+            else:
+                return upsampler.enhance(img_cv, outscale=4)
+        finally:
+            upsampler.cancel_event = None
+    
+    future = executor.submit(upscale_task)
+    try:
+        output, _ = future.result(timeout=180)  # Reduced timeout to 3 minutes
+    except FutureTimeoutError:
+        # Stop the inference thread at the next tile instead of letting it run on
+        cancel_event.set()
+        raise TimeoutError("AI upscaling timed out after 180s")
+    logger.info("Optimized AI upscaling completed")
+    
+    update_progress(80, "Converting result")
+    
+    # Convert and save with optimized quality
+    upscaled_rgb = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
+    upscaled = Image.fromarray(upscaled_rgb)
+    
+    output_buffer = io.BytesIO()
+    # Use progressive JPEG for faster loading
+    upscaled.save(output_buffer, format='JPEG', quality=90, optimize=True, progressive=True)
+    
+    update_progress(95, "Uploading result")
+    
+    # Upload to output bucket (multipart for large outputs)
+    output_key = f"output/{job_id}/upscaled.jpg"
+    s3_transfer.upload_fileobj(output_buffer, Config.S3_OUTPUT_BUCKET, output_key, 'image/jpeg')
+    
+    return output_key, original_size
+
+def process_video_job(ch, job_data, update_progress, cancel_event):
+    """Stream a video/GIF through the upscaler into a multipart upload"""
+    job_id = job_data['job_id']
+    filename = job_data.get('filename') or ''
+    output_format = 'gif' if job_data.get('content_type') == 'image/gif' or filename.lower().endswith('.gif') else 'mp4'
+    output_key = f"output/{job_id}/upscaled.{output_format}"
+    
+    update_progress(5, "Opening video")
+    # ffmpeg reads the source straight from S3, so the clip is never held in memory
+    source_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': Config.S3_INPUT_BUCKET, 'Key': job_data['s3_input_key']},
+        ExpiresIn=Config.VIDEO_SOURCE_URL_EXPIRY
+    )
+    uploader = s3_transfer.open_stream(Config.S3_OUTPUT_BUCKET, output_key,
+                                       'image/gif' if output_format == 'gif' else 'video/mp4')
+    
+    def video_task():
+        upsampler.cancel_event = cancel_event
+        try:
+            return upscale_video(upsampler, source_url, uploader, output_format, update_progress)
+        finally:
+            upsampler.cancel_event = None
+    
+    future = executor.submit(video_task)
+    deadline = time.time() + Config.VIDEO_TIMEOUT_SECONDS
+    try:
+        # Clips can take far longer than the broker heartbeat; keep the connection serviced
+        while True:
+            try:
+                original_size, stats = future.result(timeout=1)
+                break
+            except FutureTimeoutError:
+                if time.time() > deadline:
+                    raise TimeoutError(f"Video upscaling timed out after {Config.VIDEO_TIMEOUT_SECONDS:.0f}s")
+                ch.connection.process_data_events(time_limit=0)
+        update_progress(95, "Completing upload")
+        uploader.complete()
+    except BaseException:
+        cancel_event.set()
+        uploader.abort()
+        raise
+    
+    return output_key, original_size, stats
+
+def cleanup_cancelled_job(job_data):
+    """Remove the input of a cancelled job and record the final cancelled state"""
+    job_id = job_data['job_id']
+    try:
+        s3_client.delete_object(Bucket=Config.S3_INPUT_BUCKET, Key=job_data['s3_input_key'])
+    except Exception as e:
+        logger.warning(f"Failed to delete input for cancelled job {job_id}: {e}")
+    
+    redis_client.setex(f"job:{job_id}", 3600, json.dumps({
+        "status": "cancelled",
+        "cancelled_at": time.time()
+    }))
 
 def process_image(job_data):
     """Extract the existing image processing logic"""
@@ -244,13 +378,9 @@ def process_image(job_data):
     s3_input_key = job_data['s3_input_key']
     
     # Download image from S3
-    response = s3_client.get_object(
-        Bucket=Config.S3_INPUT_BUCKET,
-        Key=s3_input_key
-    )
+    image_data = s3_transfer.download_bytes(Config.S3_INPUT_BUCKET, s3_input_key)
     
     # Load and process image
-    image_data = response['Body'].read()
     image = Image.open(io.BytesIO(image_data))
     
     # Convert PIL to OpenCV format
@@ -267,16 +397,10 @@ def process_image(job_data):
     # Save upscaled image
     output_buffer = io.BytesIO()
     upscaled.save(output_buffer, format='JPEG', quality=95)
-    output_buffer.seek(0)
     
     # Upload to output bucket
     output_key = f"output/{job_id}/upscaled.jpg"
-    s3_client.put_object(
-        Bucket=Config.S3_OUTPUT_BUCKET,
-        Key=output_key,
-        Body=output_buffer.getvalue(),
-        ContentType='image/jpeg'
-    )
+    s3_transfer.upload_fileobj(output_buffer, Config.S3_OUTPUT_BUCKET, output_key, 'image/jpeg')
     
     return {
         'job_id': job_id,
@@ -285,6 +409,9 @@ def process_image(job_data):
         'model': 'Real-ESRGAN x4'
     }
 
+# Listen for cancel requests for running jobs
+cancellations.start()
+
 # Start RabbitMQ consumer in background thread
 logger.info("Starting RabbitMQ consumer thread...")
 consumer_thread = threading.Thread(target=setup_rabbitmq_consumer, daemon=True)
@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import platform
+import resource
+import threading
+import numpy as np
+import torch
+
+from config import Config
+from cancellation import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+# Rough peak activation footprint of RRDBNet x4 per padded input pixel (float32):
+# 64 + 4 * 32 channels inside the dense blocks, plus 64-channel maps at 2x and 4x
+BYTES_PER_INPUT_PIXEL = 4 * (64 + 4 * 32 + 64 * 4 + 64 * 16 + 3 * 16)
+
+
+def read_cgroup_limits():
+    """Effective CPU count and memory limit of this container (cgroup v2, then v1)"""
+    cpus = float(len(os.sched_getaffinity(0))) if hasattr(os, 'sched_getaffinity') else float(os.cpu_count() or 1)
+    memory_bytes = None
+
+    def read(path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    # cgroup v2
+    cpu_max = read('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, period = cpu_max.split()
+        if quota != 'max':
+            cpus = min(cpus, int(quota) / int(period))
+    else:
+        # cgroup v1
+        quota = read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if quota and period and int(quota) > 0:
+            cpus = min(cpus, int(quota) / int(period))
+
+    memory_max = read('/sys/fs/cgroup/memory.max') or read('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if memory_max and memory_max != 'max':
+        # cgroup v1 reports "unlimited" as a huge page-aligned number
+        if int(memory_max) < 1 << 60:
+            memory_bytes = int(memory_max)
+
+    if memory_bytes is None:
+        memory_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+    return {"cpus": max(1.0, cpus), "memory_bytes": memory_bytes}
+
+
+def hardware_fingerprint(limits):
+    """Stable key for the autotune cache: CPU model, container limits and torch build"""
+    cpu_model = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    cpu_model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+
+    parts = [
+        cpu_model,
+        platform.machine(),
+        f"{limits['cpus']:.2f}",
+        str(limits['memory_bytes'] // (64 * 1024 * 1024)),
+        torch.__version__,
+        ','.join(str(t) for t in Config.AUTOTUNE_TILE_SIZES),
+        str(Config.AUTOTUNE_IMAGE_SIZE),
+    ]
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:16]
+
+
+def estimate_tile_memory(tile, tile_pad):
+    return (tile + 2 * tile_pad) ** 2 * BYTES_PER_INPUT_PIXEL
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def thread_candidates(cpus):
+    whole = max(1, int(cpus))
+    return sorted({1, max(1, whole // 2), whole}, reverse=True)
+
+
+def timed_run(upsampler, img, time_limit):
+    """Seconds for one enhance, or None if it was cut off after `time_limit` seconds"""
+    stop = threading.Event()
+    timer = threading.Timer(time_limit, stop.set)
+    upsampler.cancel_event = stop
+    timer.start()
+    start_time = time.perf_counter()
+    try:
+        upsampler.enhance(img, outscale=upsampler.scale)
+        return time.perf_counter() - start_time
+    except JobCancelled:
+        return None
+    finally:
+        timer.cancel()
+        upsampler.cancel_event = None
+
+
+def benchmark(upsampler, limits):
+    """Time (tile, threads) pairs on a synthetic image within AUTOTUNE_TIME_BUDGET_SECONDS.
+
+    Every tile is timed at the CPU-quota thread count first, then the other
+    thread counts are tried on the fastest tile. Tiles over the memory budget
+    are skipped, and a run is stopped at its next tile once it is
+    AUTOTUNE_PRUNE_RATIO slower than the best run so far.
+
+    Returns (results, complete); complete is False when the budget ran out.
+    """
+    budget = limits['memory_bytes'] * Config.AUTOTUNE_MEMORY_FRACTION
+    size = Config.AUTOTUNE_IMAGE_SIZE
+    rng = np.random.default_rng(0)
+    test_img = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+
+    original_tile = upsampler.tile_size
+    original_threads = torch.get_num_threads()
+    deadline = time.monotonic() + Config.AUTOTUNE_TIME_BUDGET_SECONDS
+    results = []
+
+    def measure(tile, threads):
+        """Append the timing of one pair to results; False once the time budget is spent"""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.info("Autotune: time budget spent, keeping the best result so far")
+            return False
+
+        upsampler.tile_size = tile
+        torch.set_num_threads(threads)
+        best_seconds = min((r["seconds"] for r in results), default=None)
+        timings = []
+        for _ in range(Config.AUTOTUNE_REPEATS):
+            time_limit = remaining if best_seconds is None else min(remaining, best_seconds * Config.AUTOTUNE_PRUNE_RATIO)
+            seconds = timed_run(upsampler, test_img, time_limit)
+            if seconds is None:
+                break
+            timings.append(seconds)
+            remaining = deadline - time.monotonic()
+
+        if not timings:
+            logger.info(f"Autotune: tile={tile} threads={threads} stopped after {time_limit:.1f}s")
+            return deadline - time.monotonic() > 0
+
+        seconds = min(timings)
+        peak_rss = max_rss_bytes()
+        results.append({
+            "tile": tile,
+            "threads": threads,
+            "seconds": seconds,
+            "peak_rss_bytes": peak_rss,
+            "fits": peak_rss <= budget
+        })
+        logger.info(f"Autotune: tile={tile} threads={threads} -> {seconds:.3f}s, "
+                    f"peak RSS {peak_rss / 1024 / 1024:.0f} MB")
+        return True
+
+    candidates = thread_candidates(limits['cpus'])
+    quota_threads = candidates[0]
+    try:
+        # Ascending tile order: ru_maxrss only grows, so after each tile it is that tile's peak
+        for tile in sorted(Config.AUTOTUNE_TILE_SIZES):
+            if max_rss_bytes() + estimate_tile_memory(tile, upsampler.tile_pad) > budget:
+                logger.info(f"Autotune: skipping tile={tile}, estimated memory exceeds budget")
+                continue
+            if not measure(tile, quota_threads):
+                return results, False
+            if max_rss_bytes() > budget:
+                # Larger tiles will only need more memory
+                break
+
+        fitting = [r for r in results if r["fits"]]
+        if fitting:
+            best_tile = min(fitting, key=lambda r: r["seconds"])["tile"]
+            for threads in candidates[1:]:
+                if not measure(best_tile, threads):
+                    return results, False
+    finally:
+        upsampler.tile_size = original_tile
+        torch.set_num_threads(original_threads)
+
+    return results, True
+
+
+def autotune(upsampler):
+    """Pick (and cache on disk) the fastest tile size and intra-op thread count for this hardware.
+
+    Returns the applied settings. Falls back to the current tile size with a
+    thread count matching the cgroup CPU quota when tuning is disabled or fails.
+    """
+    limits = read_cgroup_limits()
+    fallback = {"tile": upsampler.tile_size, "threads": max(1, int(limits['cpus'])), "source": "default"}
+
+    if not Config.AUTOTUNE_ENABLED:
+        return apply_settings(upsampler, fallback)
+
+    fingerprint = hardware_fingerprint(limits)
+    cache_path = os.path.join(Config.AUTOTUNE_CACHE_DIR, f"autotune-{fingerprint}.json")
+
+    try:
+        with open(cache_path) as f:
+            settings = json.load(f)
+        settings["source"] = "cache"
+        logger.info(f"Autotune: using cached settings from {cache_path}")
+        return apply_settings(upsampler, settings)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        logger.info(f"Autotune: benchmarking for {limits['cpus']:.2f} CPUs, "
+                    f"{limits['memory_bytes'] / 1024 / 1024:.0f} MB memory limit")
+        results, complete = benchmark(upsampler, limits)
+        results = [r for r in results if r["fits"]]
+        if not results:
+            reason = "no candidate fits the memory budget" if complete else "no run finished within the time budget"
+            logger.warning(f"Autotune: {reason}, keeping defaults")
+            return apply_settings(upsampler, fallback)
+
+        best = min(results, key=lambda r: r["seconds"])
+        settings = {
+            "tile": best["tile"],
+            "threads": best["threads"],
+            "seconds": best["seconds"],
+            "fingerprint": fingerprint,
+            "limits": limits,
+            "results": results,
+            "tuned_at": time.time()
+        }
+
+        if complete:
+            os.makedirs(Config.AUTOTUNE_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(settings, f, indent=2)
+            os.replace(tmp_path, cache_path)
+        else:
+            # Not cached, so the next start benchmarks again instead of trusting a partial grid
+            logger.info("Autotune: benchmark hit the time budget, applying the best result without caching it")
+
+        settings["source"] = "benchmark" if complete else "partial_benchmark"
+        return apply_settings(upsampler, settings)
+    except Exception as e:
+        logger.warning(f"Autotune failed, keeping defaults: {e}")
+        return apply_settings(upsampler, fallback)
+
+
+def apply_settings(upsampler, settings):
+    upsampler.tile_size = settings["tile"]
+    torch.set_num_threads(settings["threads"])
+    logger.info(f"Autotune ({settings['source']}): tile={settings['tile']}, threads={settings['threads']}")
+    return {"tile": settings["tile"], "threads": settings["threads"], "source": settings["source"]}
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CANCEL_CHANNEL = 'job_cancellations'
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it has been cancelled by the user"""
+
+
+def cancel_flag_key(job_id):
+    return f"job:{job_id}:cancelled"
+
+
+class CancellationWatcher:
+    """Tracks cancel requests for jobs running in this worker.
+
+    The API sets a `job:{job_id}:cancelled` flag (checked at dequeue time) and
+    publishes the job id on CANCEL_CHANNEL, which trips the in-process event
+    of a job that is already running so the tile loop can stop.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        thread = threading.Thread(target=self._listen, daemon=True, name='cancellation-watcher')
+        thread.start()
+        return thread
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CANCEL_CHANNEL)
+                logger.info(f"Listening for job cancellations on '{CANCEL_CHANNEL}'")
+                for message in pubsub.listen():
+                    job_id = message['data'].decode() if isinstance(message['data'], bytes) else message['data']
+                    with self._lock:
+                        event = self._events.get(job_id)
+                    if event is not None:
+                        logger.info(f"Cancellation received for running job {job_id}")
+                        event.set()
+            except Exception as e:
+                logger.warning(f"Cancellation listener error, reconnecting: {e}")
+                time.sleep(1)
+
+    def is_cancelled(self, job_id):
+        return bool(self.redis_client.exists(cancel_flag_key(job_id)))
+
+    def watch(self, job_id):
+        """Register a running job and return the event that is set when it is cancelled"""
+        event = threading.Event()
+        with self._lock:
+            self._events[job_id] = event
+        # Close the race with a cancel published before we subscribed to this job
+        if self.is_cancelled(job_id):
+            event.set()
+        return event
+
+    def unwatch(self, job_id):
+        with self._lock:
+            self._events.pop(job_id, None)
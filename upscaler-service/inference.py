@@ -0,0 +1,281 @@
+import math
+import logging
+import threading
+from contextlib import nullcontext
+import numpy as np
+import torch
+from torch.nn import functional as F
+from realesrgan import RealESRGANer
+
+from config import Config
+from cancellation import JobCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class TiledUpsampler(RealESRGANer):
+    """RealESRGANer with a tile loop that can be aborted between tiles.
+
+    With adaptive_threshold > 0, blocks whose edge density falls below the
+    threshold (sky, backgrounds, solid borders) are upscaled with bicubic
+    interpolation instead of the network, and overlapping paddings are
+    feathered together so model and bicubic regions meet without visible seams.
+    """
+
+    def __init__(self, scale, model_path, model=None, tile=0, tile_pad=10, pre_pad=10, half=False, device=None, **kwargs):
+        if model_path is not None:
+            super().__init__(scale, model_path, model=model, tile=tile, tile_pad=tile_pad,
+                             pre_pad=pre_pad, half=half, device=device, **kwargs)
+        else:
+            # Weights were already loaded into `model` (e.g. memory-mapped), skip torch.load
+            self.scale = scale
+            self.tile_size = tile
+            self.tile_pad = tile_pad
+            self.pre_pad = pre_pad
+            self.mod_scale = None
+            self.half = half
+            self.device = torch.device('cpu') if device is None else device
+            model.eval()
+            self.model = model.to(self.device)
+            if self.half:
+                self.model = self.model.half()
+
+        # Cancel events are per thread: a timed-out job's thread must keep seeing its own
+        # tripped event even after the next job has started on another executor thread
+        self._local = threading.local()
+        # RealESRGANer keeps img/output on the instance, so only one thread may run inference at a time
+        self.inference_lock = threading.Lock()
+        self.adaptive_threshold = Config.ADAPTIVE_TILE_THRESHOLD
+        self.routing_block = Config.ADAPTIVE_ROUTING_BLOCK
+        # Feather tile overlaps even with routing off (quality_report's reference)
+        self.force_blend = False
+        self.last_routing_stats = None
+        # profiling.TorchTraceCapture, set by the worker; idle unless a trace is requested
+        self.trace_capture = None
+
+    @property
+    def cancel_event(self):
+        return getattr(self._local, 'cancel_event', None)
+
+    @cancel_event.setter
+    def cancel_event(self, event):
+        self._local.cancel_event = event
+
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise JobCancelled("Job cancelled during inference")
+
+    def process(self):
+        self._check_cancelled()
+        super().process()
+
+    def _traced(self, label):
+        return self.trace_capture.record(label) if self.trace_capture is not None else nullcontext()
+
+    def enhance(self, img, *args, **kwargs):
+        with self.inference_lock, self._traced('enhance'):
+            return super().enhance(img, *args, **kwargs)
+
+    def enhance_batch(self, frames):
+        """Upscale a list of same-sized 8-bit BGR frames in one pass through the tile loop"""
+        with self.inference_lock, self._traced('enhance_batch'):
+            return self._enhance_batch(frames)
+
+    @torch.no_grad()
+    def _enhance_batch(self, frames):
+        batch = np.stack(frames)[..., ::-1].transpose(0, 3, 1, 2)  # NHWC BGR -> NCHW RGB
+        self.img = torch.from_numpy(np.ascontiguousarray(batch)).to(self.device).float().div_(255.0)
+        if self.half:
+            self.img = self.img.half()
+
+        # Same padding as pre_process, for a whole batch
+        if self.pre_pad != 0:
+            self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
+        if self.scale == 2:
+            self.mod_scale = 2
+        elif self.scale == 1:
+            self.mod_scale = 4
+        if self.mod_scale is not None:
+            _, _, h, w = self.img.size()
+            self.mod_pad_h = (self.mod_scale - h % self.mod_scale) % self.mod_scale
+            self.mod_pad_w = (self.mod_scale - w % self.mod_scale) % self.mod_scale
+            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+
+        if self.tile_size > 0:
+            self.tile_process()
+        else:
+            self.process()
+        output = self.post_process().float().clamp_(0, 1).mul_(255.0).round_().byte().cpu().numpy()
+
+        # NCHW RGB -> NHWC BGR
+        return [np.ascontiguousarray(frame.transpose(1, 2, 0)[..., ::-1]) for frame in output]
+
+    @staticmethod
+    def tile_complexity(tile):
+        """Edge density: mean absolute luma gradient of the tile, in [0, 1] pixel units"""
+        luma = 0.299 * tile[:, 0] + 0.587 * tile[:, 1] + 0.114 * tile[:, 2]
+        grad_x = (luma[:, :, 1:] - luma[:, :, :-1]).abs().mean(dim=(1, 2))
+        grad_y = (luma[:, 1:, :] - luma[:, :-1, :]).abs().mean(dim=(1, 2))
+        # The most detailed image in a batch decides for the whole tile
+        return ((grad_x + grad_y) / 2).max().item()
+
+    def _feather(self, length, start, end, total):
+        """1D blend weights over a padded tile span: linear ramps across the overlap, 1 at image borders"""
+        ramp = 2 * self.tile_pad * self.scale
+        positions = torch.arange(length, dtype=self.output.dtype) + 0.5
+        weights = torch.ones(length, dtype=self.output.dtype)
+        if start > 0:
+            # This tile's padded span begins tile_pad before its core; ramp up across both paddings
+            weights = torch.minimum(weights, (positions / ramp).clamp(max=1))
+        if end < total:
+            weights = torch.minimum(weights, ((length - positions) / ramp).clamp(max=1))
+        return weights
+
+    def tile_process(self):
+        """Same tiling as RealESRGANer.tile_process, with a cancellation check between tiles
+        and optional routing of flat blocks to bicubic interpolation"""
+        if self.adaptive_threshold > 0 or self.force_blend:
+            self._adaptive_tile_process()
+            return
+
+        batch, channel, height, width = self.img.shape
+        output_height = height * self.scale
+        output_width = width * self.scale
+        output_shape = (batch, channel, output_height, output_width)
+
+        # start with black image
+        self.output = self.img.new_zeros(output_shape)
+        tiles_x = math.ceil(width / self.tile_size)
+        tiles_y = math.ceil(height / self.tile_size)
+
+        for y in range(tiles_y):
+            for x in range(tiles_x):
+                self._check_cancelled()
+
+                # input tile area on total image
+                input_start_x = x * self.tile_size
+                input_end_x = min(input_start_x + self.tile_size, width)
+                input_start_y = y * self.tile_size
+                input_end_y = min(input_start_y + self.tile_size, height)
+
+                # input tile area on total image with padding
+                input_start_x_pad = max(input_start_x - self.tile_pad, 0)
+                input_end_x_pad = min(input_end_x + self.tile_pad, width)
+                input_start_y_pad = max(input_start_y - self.tile_pad, 0)
+                input_end_y_pad = min(input_end_y + self.tile_pad, height)
+
+                input_tile_width = input_end_x - input_start_x
+                input_tile_height = input_end_y - input_start_y
+                input_tile = self.img[:, :, input_start_y_pad:input_end_y_pad, input_start_x_pad:input_end_x_pad]
+
+                with torch.no_grad():
+                    output_tile = self.model(input_tile)
+                logger.debug(f"Tile {y * tiles_x + x + 1}/{tiles_x * tiles_y}")
+
+                # output tile area on total image
+                output_start_x = input_start_x * self.scale
+                output_end_x = input_end_x * self.scale
+                output_start_y = input_start_y * self.scale
+                output_end_y = input_end_y * self.scale
+
+                # output tile area without padding
+                output_start_x_tile = (input_start_x - input_start_x_pad) * self.scale
+                output_end_x_tile = output_start_x_tile + input_tile_width * self.scale
+                output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
+                output_end_y_tile = output_start_y_tile + input_tile_height * self.scale
+
+                self.output[:, :, output_start_y:output_end_y, output_start_x:output_end_x] = \
+                    output_tile[:, :, output_start_y_tile:output_end_y_tile, output_start_x_tile:output_end_x_tile]
+
+        self.last_routing_stats = None
+
+    def _accumulate(self, start_y, end_y, start_x, end_x, use_model):
+        """Upscale one region plus its padding and add it to the output with feathered weights"""
+        height, width = self.img.shape[2:]
+        start_y_pad = max(start_y - self.tile_pad, 0)
+        end_y_pad = min(end_y + self.tile_pad, height)
+        start_x_pad = max(start_x - self.tile_pad, 0)
+        end_x_pad = min(end_x + self.tile_pad, width)
+        input_tile = self.img[:, :, start_y_pad:end_y_pad, start_x_pad:end_x_pad]
+
+        if use_model:
+            with torch.no_grad():
+                output_tile = self.model(input_tile)
+        else:
+            output_tile = F.interpolate(input_tile, scale_factor=self.scale, mode='bicubic', align_corners=False).clamp_(0, 1)
+
+        out_y = slice(start_y_pad * self.scale, end_y_pad * self.scale)
+        out_x = slice(start_x_pad * self.scale, end_x_pad * self.scale)
+        mask = (self._feather(out_y.stop - out_y.start, start_y_pad, end_y_pad, height)[:, None]
+                * self._feather(out_x.stop - out_x.start, start_x_pad, end_x_pad, width)[None, :])
+        self.output[:, :, out_y, out_x] += output_tile * mask
+        self.weight[:, :, out_y, out_x] += mask
+
+    def _adaptive_tile_process(self):
+        """Route fixed-size blocks (ADAPTIVE_ROUTING_BLOCK px, independent of the tile size)
+        between the network and bicubic, feathering every overlap.
+
+        Memory tiles are groups of whole blocks. A group with only detailed blocks
+        (or only flat ones) is upscaled in one call. A mixed group runs the network
+        on its detailed blocks alone and bicubic on the rest, but only when the
+        detailed blocks plus their padding cover less than the padded group;
+        otherwise the whole group goes through the network, which is cheaper and
+        seam-free.
+        """
+        batch, channel, height, width = self.img.shape
+        self.output = self.img.new_zeros((batch, channel, height * self.scale, width * self.scale))
+        self.weight = self.img.new_zeros((1, 1, height * self.scale, width * self.scale))
+
+        block = max(1, min(self.routing_block, self.tile_size))
+        group = max(1, self.tile_size // block)
+        blocks_y = math.ceil(height / block)
+        blocks_x = math.ceil(width / block)
+
+        def span(index, limit):
+            return index * block, min((index + 1) * block, limit)
+
+        def padded_area(start_y, end_y, start_x, end_x):
+            return ((min(end_y + self.tile_pad, height) - max(start_y - self.tile_pad, 0))
+                    * (min(end_x + self.tile_pad, width) - max(start_x - self.tile_pad, 0)))
+
+        # Complexity of each block including its padding, so detail just outside still counts
+        detailed = [[True] * blocks_x for _ in range(blocks_y)]
+        if self.adaptive_threshold > 0:
+            for by in range(blocks_y):
+                start_y, end_y = span(by, height)
+                for bx in range(blocks_x):
+                    start_x, end_x = span(bx, width)
+                    region = self.img[:, :, max(start_y - self.tile_pad, 0):min(end_y + self.tile_pad, height),
+                                      max(start_x - self.tile_pad, 0):min(end_x + self.tile_pad, width)]
+                    detailed[by][bx] = self.tile_complexity(region) >= self.adaptive_threshold
+
+        interpolated = 0
+        for gy in range(0, blocks_y, group):
+            for gx in range(0, blocks_x, group):
+                self._check_cancelled()
+                rows = range(gy, min(gy + group, blocks_y))
+                cols = range(gx, min(gx + group, blocks_x))
+                start_y, end_y = span(rows[0], height)[0], span(rows[-1], height)[1]
+                start_x, end_x = span(cols[0], width)[0], span(cols[-1], width)[1]
+                flat = sum(not detailed[by][bx] for by in rows for bx in cols)
+                model_area = sum(padded_area(*span(by, height), *span(bx, width))
+                                 for by in rows for bx in cols if detailed[by][bx])
+
+                if flat == len(rows) * len(cols):
+                    self._accumulate(start_y, end_y, start_x, end_x, use_model=False)
+                    interpolated += flat
+                elif not flat or model_area >= padded_area(start_y, end_y, start_x, end_x):
+                    self._accumulate(start_y, end_y, start_x, end_x, use_model=True)
+                else:
+                    for by in rows:
+                        for bx in cols:
+                            self._accumulate(*span(by, height), *span(bx, width), use_model=detailed[by][bx])
+                    interpolated += flat
+                logger.debug(f"Tile group ({gy}, {gx}) of {blocks_y}x{blocks_x} blocks")
+
+        self.output /= self.weight
+        self.weight = None
+
+        self.last_routing_stats = {"blocks": blocks_y * blocks_x, "interpolated_blocks": interpolated}
+        if interpolated:
+            logger.info(f"Adaptive routing: {interpolated}/{blocks_y * blocks_x} blocks upscaled with bicubic")
@@ -0,0 +1,112 @@
+"""Quality/speed report for adaptive tile routing.
+
+Upscales each image once with the full model on every block and once per
+threshold with adaptive routing, then reports PSNR/SSIM of the adaptive
+output against the full-model output, the share of blocks that skipped the
+network and the speedup. Both go through the same feathered tile path, so
+the numbers measure routing alone:
+
+    python quality_report.py photo1.jpg photo2.png --thresholds 0.005,0.01,0.02
+"""
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+import cv2
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+from inference import TiledUpsampler
+from weights import load_shared_weights
+
+MODEL_PATH = '/app/weights/RealESRGAN_x4plus.pth'
+
+
+def psnr(reference, candidate):
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+
+def ssim(reference, candidate):
+    """Mean SSIM on luma with the standard 11x11 Gaussian window (Wang et al. 2004)"""
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    x = cv2.cvtColor(reference, cv2.COLOR_BGR2GRAY).astype(np.float64)
+    y = cv2.cvtColor(candidate, cv2.COLOR_BGR2GRAY).astype(np.float64)
+
+    def blur(img):
+        return cv2.GaussianBlur(img, (11, 11), 1.5)
+
+    mu_x, mu_y = blur(x), blur(y)
+    sigma_x = blur(x * x) - mu_x ** 2
+    sigma_y = blur(y * y) - mu_y ** 2
+    sigma_xy = blur(x * y) - mu_x * mu_y
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (sigma_x + sigma_y + c2))
+    return float(ssim_map.mean())
+
+
+def timed_enhance(upsampler, img, threshold):
+    upsampler.adaptive_threshold = threshold
+    # threshold 0 routes nothing but must still blend like the adaptive runs
+    upsampler.force_blend = True
+    try:
+        start_time = time.perf_counter()
+        output, _ = upsampler.enhance(img, outscale=upsampler.scale)
+        return output, time.perf_counter() - start_time, upsampler.last_routing_stats
+    finally:
+        upsampler.force_blend = False
+
+
+def quality_report(upsampler, img, thresholds):
+    """Compare adaptive routing at each threshold against the full-model output for one BGR image"""
+    reference, reference_seconds, _ = timed_enhance(upsampler, img, 0)
+    rows = []
+    for threshold in thresholds:
+        output, seconds, stats = timed_enhance(upsampler, img, threshold)
+        rows.append({
+            "threshold": threshold,
+            "psnr_db": round(psnr(reference, output), 2),
+            "ssim": round(ssim(reference, output), 4),
+            "interpolated_blocks": stats["interpolated_blocks"] if stats else 0,
+            "blocks": stats["blocks"] if stats else 0,
+            "seconds": round(seconds, 3),
+            "speedup": round(reference_seconds / seconds, 2)
+        })
+    return {"full_model_seconds": round(reference_seconds, 3), "thresholds": rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--thresholds', default='0.005,0.01,0.02')
+    parser.add_argument('--tile', type=int, default=256)
+    parser.add_argument('--routing-block', type=int, default=None, help="Defaults to ADAPTIVE_ROUTING_BLOCK")
+    parser.add_argument('--max-dimension', type=int, default=512, help="Match the worker's input cap")
+    parser.add_argument('--model-path', default=MODEL_PATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+    load_shared_weights(model, args.model_path)
+    upsampler = TiledUpsampler(scale=4, model_path=None, model=model, tile=args.tile, tile_pad=5, pre_pad=0, device='cpu')
+    if args.routing_block:
+        upsampler.routing_block = args.routing_block
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+
+    report = {}
+    for path in args.images:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"Could not read {path}", file=sys.stderr)
+            continue
+        scale = args.max_dimension / max(img.shape[:2])
+        if scale < 1:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        report[path] = quality_report(upsampler, img, thresholds)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+def create_s3_client():
+    """Create an S3 client with a connection pool sized for parallel transfers"""
+    s3_client_config = {
+        'aws_access_key_id': Config.AWS_ACCESS_KEY_ID,
+        'aws_secret_access_key': Config.AWS_SECRET_ACCESS_KEY,
+        'region_name': Config.AWS_DEFAULT_REGION,
+        'config': BotoConfig(
+            max_pool_connections=Config.S3_MAX_POOL_CONNECTIONS,
+            retries={'max_attempts': 5, 'mode': 'adaptive'},
+            tcp_keepalive=True
+        )
+    }
+
+    # Only use endpoint_url for local development (LocalStack)
+    if Config.AWS_ENDPOINT_URL:
+        s3_client_config['endpoint_url'] = Config.AWS_ENDPOINT_URL
+
+    return boto3.client('s3', **s3_client_config)
+
+
+class S3Transfer:
+    """Parallel S3 I/O for the worker: ranged GETs into preallocated buffers, multipart uploads"""
+
+    def __init__(self, client=None):
+        self.client = client or create_s3_client()
+        self.part_size = Config.S3_MULTIPART_CHUNKSIZE
+        self.max_concurrency = Config.S3_MAX_CONCURRENCY
+        self.transfer_config = TransferConfig(
+            multipart_threshold=Config.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=Config.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=Config.S3_MAX_CONCURRENCY,
+            use_threads=True
+        )
+        # Shared pool for ranged GETs so we don't pay thread startup per job
+        self.executor = ThreadPoolExecutor(
+            max_workers=Config.S3_MAX_CONCURRENCY,
+            thread_name_prefix='s3-range'
+        )
+
+    def download_bytes(self, bucket, key):
+        """Download an object, fetching byte ranges concurrently into one preallocated buffer.
+
+        The first range doubles as the size probe (ContentRange), so objects
+        up to one part cost a single GET like a plain get_object.
+        """
+        start_time = time.time()
+        try:
+            first = self.client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{self.part_size - 1}")
+        except ClientError as e:
+            # Ranges are unsatisfiable on empty objects
+            if e.response.get('Error', {}).get('Code') != 'InvalidRange':
+                raise
+            first = self.client.get_object(Bucket=bucket, Key=key)
+        content_range = first.get('ContentRange')
+        size = int(content_range.rsplit('/', 1)[1]) if content_range else first['ContentLength']
+
+        if size <= self.part_size:
+            data = first['Body'].read()
+            logger.info(f"Downloaded s3://{bucket}/{key} ({size} bytes) in {time.time() - start_time:.3f}s")
+            return data
+
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        ranges = [(offset, min(offset + self.part_size, size) - 1) for offset in range(0, size, self.part_size)]
+
+        def read_into(body, first_byte, last_byte):
+            target = view[first_byte:last_byte + 1]
+            received = 0
+            while received < len(target):
+                chunk = body.read(len(target) - received)
+                if not chunk:
+                    raise IOError(f"Short read for s3://{bucket}/{key} range {first_byte}-{last_byte}")
+                target[received:received + len(chunk)] = chunk
+                received += len(chunk)
+
+        def fetch_range(byte_range):
+            first_byte, last_byte = byte_range
+            if first_byte == 0:
+                body = first['Body']
+            else:
+                body = self.client.get_object(Bucket=bucket, Key=key, Range=f"bytes={first_byte}-{last_byte}")['Body']
+            read_into(body, first_byte, last_byte)
+
+        try:
+            # list() re-raises the first failed range
+            list(self.executor.map(fetch_range, ranges))
+        finally:
+            view.release()
+
+        logger.info(f"Downloaded s3://{bucket}/{key} ({size} bytes, {len(ranges)} ranges) "
+                    f"in {time.time() - start_time:.3f}s")
+        return buffer
+
+    def upload_fileobj(self, fileobj, bucket, key, content_type):
+        """Upload a file-like object, switching to concurrent multipart above the threshold"""
+        start_time = time.time()
+        fileobj.seek(0)
+        self.client.upload_fileobj(
+            fileobj,
+            bucket,
+            key,
+            ExtraArgs={'ContentType': content_type},
+            Config=self.transfer_config
+        )
+        logger.info(f"Uploaded s3://{bucket}/{key} in {time.time() - start_time:.3f}s")
+
+    def upload_bytes(self, data, bucket, key, content_type):
+        """Upload an in-memory payload without copying it"""
+        self.upload_fileobj(io.BytesIO(data), bucket, key, content_type)
+
+    def open_stream(self, bucket, key, content_type):
+        """Start a chunked multipart upload for output whose size is not known up front"""
+        return MultipartStreamUploader(self.client, bucket, key, content_type, self.part_size)
+
+
+class MultipartStreamUploader:
+    """Multipart upload fed incrementally; holds at most one part in memory"""
+
+    # S3 rejects non-final parts smaller than 5 MiB
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, client, bucket, key, content_type, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_uploaded = 0
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type
+        )['UploadId']
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _upload_part(self, data):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.bytes_uploaded += len(data)
+
+    def complete(self):
+        # The final part may be smaller than the minimum (or the only part)
+        if self.buffer or not self.parts:
+            self._upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+        logger.info(f"Streamed s3://{self.bucket}/{self.key} ({self.bytes_uploaded} bytes, {len(self.parts)} parts)")
+
+    def abort(self):
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.warning(f"Failed to abort multipart upload for s3://{self.bucket}/{self.key}: {e}")
+
+
+if __name__ == "__main__":
+    # Round-trip self check, e.g. against LocalStack:
+    #   AWS_ENDPOINT_URL=http://localhost:4566 python s3_transfer.py [size_mb]
+    import os
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    payload = os.urandom(size_mb * 1024 * 1024)
+    test_key = f"selftest/s3_transfer_{int(time.time())}.bin"
+
+    transfer = S3Transfer()
+    transfer.upload_bytes(payload, Config.S3_OUTPUT_BUCKET, test_key, 'application/octet-stream')
+    downloaded = transfer.download_bytes(Config.S3_OUTPUT_BUCKET, test_key)
+    transfer.client.delete_object(Bucket=Config.S3_OUTPUT_BUCKET, Key=test_key)
+
+    if bytes(downloaded) != payload:
+        print("S3 transfer round trip FAILED: payload mismatch")
+        sys.exit(1)
+    print(f"S3 transfer round trip OK ({size_mb} MB)")
@@ -0,0 +1,150 @@
+"""torch.profiler capture of upcoming inferences for /debug/profile/torch (worker only)"""
+import io
+import os
+import asyncio
+import logging
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import contextmanager, nullcontext
+from fastapi import APIRouter, Depends, HTTPException, Query
+import torch
+from config import Config
+from profiling import artifact, require_debug_token
+
+logger = logging.getLogger(__name__)
+
+
+class TorchTraceCapture:
+    """Runs torch.profiler around the next K inferences once armed; a no-op otherwise.
+
+    The upsampler wraps each enhance call in record(). Every captured
+    inference yields a Chrome trace, folded stacks and an operator summary,
+    read into memory right away so a late inference can't race the download.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.results = []
+        self.captured = 0
+        self.in_flight = 0
+        self.finished = threading.Event()
+
+    @property
+    def armed(self):
+        return self.remaining > 0
+
+    def arm(self, inferences):
+        with self.lock:
+            if self.remaining > 0 or self.in_flight:
+                return False
+            self.remaining = inferences
+            self.results = []
+            self.captured = 0
+            self.finished.clear()
+            return True
+
+    def collect(self):
+        """Disarm and return whatever finished; inferences still running are dropped"""
+        with self.lock:
+            self.remaining = 0
+            results, self.results = self.results, []
+            return results
+
+    def record(self, label):
+        # Unlocked read: the hot path pays one attribute check while disarmed
+        if self.remaining <= 0:
+            return nullcontext()
+        return self._record(label)
+
+    @contextmanager
+    def _record(self, label):
+        with self.lock:
+            if self.remaining <= 0:
+                index = None
+            else:
+                self.remaining -= 1
+                self.in_flight += 1
+                self.captured += 1
+                index = self.captured
+        if index is None:
+            yield
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        # verbose keeps the Python frames export_stacks needs for the folded output
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True, with_stack=True,
+                                          experimental_config=torch.profiler._ExperimentalConfig(verbose=True))
+        try:
+            with profiler:
+                with torch.profiler.record_function(label):
+                    yield
+        finally:
+            # A failed export must never fail the job being profiled
+            try:
+                files = self._export(profiler, index)
+            except Exception as e:
+                logger.warning(f"Failed to export torch trace for inference {index}: {e}")
+                files = {}
+            with self.lock:
+                self.in_flight -= 1
+                if files:
+                    self.results.append(files)
+                if self.remaining <= 0 and not self.in_flight:
+                    self.finished.set()
+
+    @staticmethod
+    def _export(profiler, index):
+        files = {}
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        exports = {
+            f"inference-{index}.trace.json": profiler.export_chrome_trace,
+            f"inference-{index}.stacks.folded": lambda path: profiler.export_stacks(path, f"self_{device}_time_total"),
+        }
+        for name, export in exports.items():
+            fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+            os.close(fd)
+            try:
+                export(path)
+                with open(path, 'rb') as f:
+                    files[name] = f.read()
+            finally:
+                os.remove(path)
+        files[f"inference-{index}.summary.txt"] = profiler.key_averages().table(
+            sort_by=f"self_{device}_time_total", row_limit=40).encode()
+        return files
+
+
+torch_capture = TorchTraceCapture()
+
+
+# Same prefix and token check as the shared /debug/profile routes
+router = APIRouter(prefix="/debug/profile", dependencies=[Depends(require_debug_token)], include_in_schema=False)
+
+
+@router.get("/torch")
+async def profile_torch(
+    inferences: int = Query(1, ge=1, le=Config.DEBUG_TORCH_MAX_INFERENCES),
+    timeout: float = Query(300, gt=0, le=Config.DEBUG_TORCH_MAX_WAIT_SECONDS)
+):
+    """torch.profiler traces of the next `inferences` model runs, zipped (Chrome trace, folded stacks, op summary)"""
+    if not torch_capture.arm(inferences):
+        raise HTTPException(status_code=409, detail="A torch trace capture is already running")
+    logger.info(f"Torch trace armed for the next {inferences} inference(s), waiting up to {timeout}s")
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, torch_capture.finished.wait, timeout)
+    results = torch_capture.collect()
+    if not results:
+        raise HTTPException(status_code=504, detail=f"No inference ran within {timeout}s")
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for files in results:
+            for name, content in files.items():
+                archive.writestr(name, content)
+    return artifact(buffer.getvalue(), f"worker-torch-{int(time.time())}.zip", "application/zip")
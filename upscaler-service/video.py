@@ -0,0 +1,252 @@
+import json
+import logging
+import tempfile
+import threading
+import subprocess
+from fractions import Fraction
+import numpy as np
+import cv2
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Dedup compares 128x128 thumbnails block by block (16x16 blocks of 8x8 thumbnail pixels)
+SIGNATURE_SIZE = 128
+DEDUP_GRID = 16
+
+# Fail reads/writes on a stalled source instead of blocking the worker forever (microseconds)
+RW_TIMEOUT = str(60 * 1000 * 1000)
+
+
+def probe(url):
+    """Read stream geometry, frame rate, frame count and audio presence with ffprobe"""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_streams', '-show_format', url],
+        capture_output=True, check=True, timeout=60
+    )
+    info = json.loads(result.stdout)
+    video = next(s for s in info['streams'] if s.get('codec_type') == 'video')
+
+    fps = 0.0
+    for field in ('avg_frame_rate', 'r_frame_rate'):
+        try:
+            fps = float(Fraction(video.get(field, '0/0')))
+        except (ValueError, ZeroDivisionError):
+            continue
+        if 0 < fps <= 120:
+            break
+    fps = fps if 0 < fps <= 120 else 25.0
+
+    duration = float(video.get('duration') or info.get('format', {}).get('duration') or 0)
+    frames = int(video.get('nb_frames') or 0) or int(round(duration * fps))
+
+    return {
+        "width": int(video['width']),
+        "height": int(video['height']),
+        "fps": fps,
+        "frames": frames,
+        "has_audio": any(s.get('codec_type') == 'audio' for s in info['streams']),
+        "format": info.get('format', {}).get('format_name', '')
+    }
+
+
+def capped_size(width, height, max_dimension):
+    """Scale down to the worker's input cap, keeping even dimensions for yuv420p"""
+    scale = min(1.0, max_dimension / max(width, height))
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+class FrameReader:
+    """Decodes a clip with ffmpeg into fixed-size BGR frames, one frame in memory at a time"""
+
+    def __init__(self, url, width, height, fps):
+        self.frame_bytes = width * height * 3
+        self.shape = (height, width, 3)
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-rw_timeout', RW_TIMEOUT, '-i', url,
+             '-vf', f'fps={fps},scale={width}:{height}:flags=area',
+             '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'],
+            stdout=subprocess.PIPE, stderr=self.stderr, bufsize=self.frame_bytes
+        )
+
+    def __iter__(self):
+        while True:
+            frame = np.empty(self.shape, dtype=np.uint8)
+            view = memoryview(frame).cast('B')
+            received = 0
+            while received < self.frame_bytes:
+                count = self.process.stdout.readinto(view[received:])
+                if not count:
+                    break
+                received += count
+            if received < self.frame_bytes:
+                break
+            yield frame
+
+        if self.process.wait() != 0:
+            self.stderr.seek(0)
+            raise RuntimeError(f"ffmpeg decode failed: {self.stderr.read().decode(errors='replace')[-500:]}")
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.stderr.close()
+
+
+class FrameWriter:
+    """Encodes BGR frames with ffmpeg and streams the encoded bytes to `on_chunk` from a pump thread"""
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, width, height, fps, output_format, on_chunk, audio_url=None):
+        command = ['ffmpeg', '-v', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-']
+        if output_format == 'gif':
+            # One palette per frame keeps encoding streaming (a global palette needs the whole clip)
+            command += ['-vf', 'split[a][b];[a]palettegen=stats_mode=single[p];[b][p]paletteuse=new=1',
+                        '-loop', '0', '-f', 'gif', '-']
+        else:
+            if audio_url:
+                command += ['-rw_timeout', RW_TIMEOUT, '-i', audio_url, '-map', '0:v', '-map', '1:a?', '-c:a', 'aac', '-shortest']
+            # Fragmented MP4 needs no seek back to the header, so it can be uploaded as it is produced
+            command += ['-c:v', 'libx264', '-preset', Config.VIDEO_X264_PRESET, '-crf', str(Config.VIDEO_CRF),
+                        '-pix_fmt', 'yuv420p', '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+                        '-f', 'mp4', '-']
+
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.on_chunk = on_chunk
+        self.error = None
+        self.pump = threading.Thread(target=self._pump, daemon=True, name='ffmpeg-output-pump')
+        self.pump.start()
+
+    def _pump(self):
+        try:
+            while True:
+                chunk = self.process.stdout.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.on_chunk(chunk)
+        except Exception as e:
+            self.error = e
+            # Unblock the encoder so write() notices instead of hanging on a full pipe
+            self.process.kill()
+
+    def write(self, frame):
+        if self.error:
+            raise self.error
+        self.process.stdin.write(memoryview(frame).cast('B'))
+
+    def finish(self):
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.pump.join()
+        if self.error:
+            raise self.error
+        if returncode != 0:
+            self.stderr.seek(0)
+            raise RuntimeError(f"ffmpeg encode failed: {self.stderr.read().decode(errors='replace')[-500:]}")
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.pump.join(timeout=5)
+        self.stderr.close()
+
+
+def frame_signature(frame):
+    """Grayscale thumbnail used to spot (near-)identical consecutive frames"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (SIGNATURE_SIZE, SIGNATURE_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def frame_difference(signature, reference):
+    """Largest mean absolute difference over a DEDUP_GRID x DEDUP_GRID grid of blocks.
+
+    A global mean dilutes a small moving object into the static background;
+    the worst block keeps it visible while still averaging out codec noise.
+    """
+    diff = np.abs(signature - reference)
+    blocks = cv2.resize(diff, (DEDUP_GRID, DEDUP_GRID), interpolation=cv2.INTER_AREA)
+    return float(blocks.max())
+
+
+def upscale_video(upsampler, source_url, uploader, output_format, update_progress):
+    """Stream-decode, deduplicate, batch-upscale and stream-encode a clip into `uploader`.
+
+    Memory stays bounded by VIDEO_BATCH_SIZE frames (in and out) plus one
+    multipart part, whatever the clip length. Returns (original_size, stats).
+    """
+    info = probe(source_url)
+    if info["frames"] > Config.VIDEO_MAX_FRAMES:
+        raise ValueError(f"Clip has {info['frames']} frames, limit is {Config.VIDEO_MAX_FRAMES}")
+
+    width, height = capped_size(info["width"], info["height"], Config.VIDEO_MAX_DIMENSION)
+    fps = info["fps"]
+    total_frames = max(info["frames"], 1)
+    logger.info(f"Video {info['width']}x{info['height']} @ {fps:.2f}fps, ~{info['frames']} frames, "
+                f"processing at {width}x{height}")
+
+    reader = FrameReader(source_url, width, height, fps)
+    writer = FrameWriter(width * upsampler.scale, height * upsampler.scale, fps, output_format, uploader.write,
+                         audio_url=source_url if info["has_audio"] and output_format != 'gif' else None)
+
+    # Frames waiting for the current batch: each entry is (frame, is_duplicate)
+    pending = []
+    last_signature = None
+    last_output = None
+    stats = {"frames": 0, "unique_frames": 0, "duplicate_frames": 0}
+
+    def flush():
+        nonlocal last_output
+        unique = [frame for frame, duplicate in pending if not duplicate]
+        outputs = iter(upsampler.enhance_batch(unique)) if unique else iter(())
+        for _, duplicate in pending:
+            if not duplicate:
+                last_output = next(outputs)
+            writer.write(last_output)
+        stats["frames"] += len(pending)
+        pending.clear()
+        update_progress(
+            min(90, 10 + int(80 * stats["frames"] / total_frames)),
+            f"Upscaling frames ({stats['frames']}/{total_frames})",
+            frames_done=stats["frames"],
+            frames_total=total_frames
+        )
+
+    try:
+        for frame_count, frame in enumerate(reader, 1):
+            # ffprobe can't always count frames (some GIFs, streamed WebM), so enforce the cap here too
+            if frame_count > Config.VIDEO_MAX_FRAMES:
+                raise ValueError(f"Clip has more than {Config.VIDEO_MAX_FRAMES} frames")
+            signature = frame_signature(frame)
+            # Compare with the last *upscaled* frame so slow drift can't accumulate across duplicates
+            duplicate = (last_signature is not None
+                         and frame_difference(signature, last_signature) <= Config.VIDEO_DEDUP_THRESHOLD)
+            if duplicate:
+                stats["duplicate_frames"] += 1
+            else:
+                stats["unique_frames"] += 1
+                last_signature = signature
+            pending.append((None if duplicate else frame, duplicate))
+
+            unique_pending = sum(1 for _, d in pending if not d)
+            if unique_pending >= Config.VIDEO_BATCH_SIZE or len(pending) >= Config.VIDEO_BATCH_SIZE * 8:
+                flush()
+
+        if pending:
+            flush()
+
+        update_progress(92, "Finalizing video")
+        writer.finish()
+    finally:
+        reader.close()
+        writer.close()
+
+    logger.info(f"Video done: {stats['frames']} frames, {stats['duplicate_frames']} reused")
+    return (info["width"], info["height"]), stats
+
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Tensors start on 64-byte boundaries inside the flat file
+ALIGNMENT_ELEMENTS = 16
+
+
+def flat_paths(pth_path):
+    base = os.path.splitext(pth_path)[0]
+    return f"{base}.flat.bin", f"{base}.flat.json"
+
+
+def convert_to_flat(pth_path):
+    """Convert a Real-ESRGAN .pth checkpoint into a flat float32 file plus a JSON index.
+
+    Safe to call from several replicas at once: the first one converts under a
+    file lock, the others wait and reuse its result.
+    """
+    bin_path, index_path = flat_paths(pth_path)
+    with open(f"{bin_path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if is_flat_current(pth_path):
+            return bin_path, index_path
+
+        start_time = time.time()
+        loadnet = torch.load(pth_path, map_location=torch.device('cpu'))
+        # prefer to use params_ema, like RealESRGANer
+        state_dict = loadnet['params_ema'] if 'params_ema' in loadnet else loadnet['params']
+
+        index = {}
+        offset = 0
+        for name, tensor in state_dict.items():
+            if tensor.dtype != torch.float32:
+                raise ValueError(f"Unsupported dtype {tensor.dtype} for '{name}', expected float32")
+            index[name] = {"offset": offset, "shape": list(tensor.shape)}
+            offset += -(-tensor.numel() // ALIGNMENT_ELEMENTS) * ALIGNMENT_ELEMENTS
+
+        flat = torch.zeros(offset, dtype=torch.float32)
+        for name, tensor in state_dict.items():
+            entry = index[name]
+            flat[entry["offset"]:entry["offset"] + tensor.numel()] = tensor.reshape(-1)
+
+        tmp_bin = f"{bin_path}.{os.getpid()}.tmp"
+        tmp_index = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_bin, 'wb') as f:
+            f.write(flat.numpy().tobytes())
+        with open(tmp_index, 'w') as f:
+            json.dump({"numel": offset, "dtype": "float32", "tensors": index}, f)
+        # The mapping is read-only in every process; keep the file that way too
+        os.chmod(tmp_bin, 0o444)
+        # Index last: its presence marks a complete conversion
+        os.replace(tmp_bin, bin_path)
+        os.replace(tmp_index, index_path)
+
+        logger.info(f"Converted {pth_path} to memory-mappable weights ({offset * 4 / 1024 / 1024:.1f} MB) "
+                    f"in {time.time() - start_time:.2f}s")
+        return bin_path, index_path
+
+
+def is_flat_current(pth_path):
+    bin_path, index_path = flat_paths(pth_path)
+    if not (os.path.exists(bin_path) and os.path.exists(index_path)):
+        return False
+    return os.path.getmtime(index_path) >= os.path.getmtime(pth_path)
+
+
+def load_flat_weights(model, bin_path, index_path):
+    """Point the model's parameters at a private, read-only mmap of the flat weight file.
+
+    Clean pages of a file mapping live in the page cache, so every worker on the
+    host that maps the same file shares one physical copy of the weights.
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+
+    # shared=False maps the file MAP_PRIVATE and read-only on disk: writes, if any, stay process-local
+    flat = torch.from_file(bin_path, shared=False, size=index["numel"], dtype=torch.float32)
+
+    tensors = index["tensors"]
+    parameters = dict(model.named_parameters())
+    missing = set(parameters) - set(tensors)
+    unexpected = set(tensors) - set(parameters)
+    if missing or unexpected:
+        raise KeyError(f"Flat weights do not match model: missing={sorted(missing)}, unexpected={sorted(unexpected)}")
+
+    for name, entry in tensors.items():
+        numel = 1
+        for dim in entry["shape"]:
+            numel *= dim
+        view = flat[entry["offset"]:entry["offset"] + numel].view(entry["shape"])
+
+        module_name, _, param_name = name.rpartition('.')
+        module = model.get_submodule(module_name) if module_name else model
+        module._parameters[param_name] = torch.nn.Parameter(view, requires_grad=False)
+
+    return model
+
+
+def load_shared_weights(model, pth_path):
+    """Load weights through the memory-mapped flat file, converting the .pth on first use"""
+    start_time = time.time()
+    if is_flat_current(pth_path):
+        bin_path, index_path = flat_paths(pth_path)
+    else:
+        bin_path, index_path = convert_to_flat(pth_path)
+
+    load_flat_weights(model, bin_path, index_path)
+    model.eval()
+    logger.info(f"Mapped weights from {bin_path} in {time.time() - start_time:.3f}s")
+    return model
+
+
+if __name__ == "__main__":
+    # Pre-convert at image build time: python weights.py /app/weights/RealESRGAN_x4plus.pth
+    import sys
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    for path in sys.argv[1:]:
+        convert_to_flat(path)